@@ -1,23 +1,48 @@
 from __future__ import annotations
-from aiogram import Bot, Router
+from html import escape
+from aiogram import Bot, Router, F
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from aiogram.types import (Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove,
+                           InlineKeyboardMarkup, InlineKeyboardButton)
 from sqlalchemy import select
 
 from .config import settings
-from .db import SessionLocal
-from .models import User, Task
-from .logic import ensure_user, get_profile, find_task, award, leaderboard
+from .db import AsyncSessionLocal
+from .models import User
+from .logic import ensure_user, get_profile, find_task, award, award_bulk, rebuild_period_xp, reconcile_xp, current_ranking, \
+    history_page, local_time, resolve_user, AlreadyApplied
+from .levels import level_index
+from .search import task_index
+from .standings import standing
+from .users import UserSnapshot, user_cache
+from .outbox import Outbox
+from .updates import MetricsMiddleware
+from .bulk import LogEntry, MAX_DOCUMENT_BYTES, parse_log_line, parse_log_text, parse_log_document
 
 
-# Инициализация бота с корректным parse_mode для aiogram >= 3.7
-bot = Bot(
-    token=settings.telegram_token,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
-)
+def make_bot() -> Bot:
+    """Bot с корректным parse_mode для aiogram >= 3.7. Создаётся при старте сервера, а не при импорте:
+    модуль импортируется и без TELEGRAM_TOKEN (миграции, бенчмарки)."""
+    return Bot(
+        token=settings.telegram_token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+
 router = Router()
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
+# все уведомления (level-up, рассылки) идут через очередь с лимитами Telegram
+outbox = Outbox(
+    None,  # Bot подставляет сервер при старте
+    rate=settings.outbox_rate,
+    chat_interval=settings.outbox_chat_interval,
+    group_interval=settings.outbox_group_interval,
+    workers=settings.outbox_workers,
+    maxsize=settings.outbox_size,
+    max_attempts=settings.outbox_max_attempts,
+)
 
 # --- UI helpers -----------------------------------------------------------------
 
@@ -26,7 +51,7 @@ def build_main_kb(is_manager: bool) -> ReplyKeyboardMarkup:
     Менеджерам добавляем подсказку по логам.
     """
     rows: list[list[KeyboardButton]] = [
-        [KeyboardButton(text="/tasks"), KeyboardButton(text="/me")],
+        [KeyboardButton(text="/tasks"), KeyboardButton(text="/me"), KeyboardButton(text="/history")],
         [KeyboardButton(text="/top week"), KeyboardButton(text="/top month"), KeyboardButton(text="/top all")],
     ]
     if is_manager:
@@ -40,16 +65,16 @@ def build_main_kb(is_manager: bool) -> ReplyKeyboardMarkup:
 
 # --- Permissions ----------------------------------------------------------------
 
-def is_manager(user: User) -> bool:
+def is_manager(user: User | UserSnapshot) -> bool:
     return user.is_manager or (user.tg_id in settings.manager_id_set)
 
 # --- Commands -------------------------------------------------------------------
 
 @router.message(Command("start"))
 async def cmd_start(msg: Message):
-    with SessionLocal() as db:
-        u = ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
-        prof = get_profile(db, u)
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+        prof = get_profile(u)
         parts = [f"Привет, <b>{msg.from_user.full_name}</b>!", f"Твой XP: <b>{u.xp_total}</b>"]
         if prof.level:
             parts.append(f"Твой уровень: <b>{prof.level.num}</b> — {prof.level.title} (порог {prof.level.xp_required} XP)")
@@ -62,8 +87,8 @@ async def cmd_start(msg: Message):
 @router.message(Command("menu"))
 async def cmd_menu(msg: Message):
     """Показать клавиатуру, если её скрыли."""
-    with SessionLocal() as db:
-        u = ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
         await msg.answer("Меню:", reply_markup=build_main_kb(is_manager(u)))
 
 @router.message(Command("hide"))
@@ -77,12 +102,15 @@ async def cmd_help(msg: Message):
         "• /tasks — список заданий\n"
         "• /me — мой профиль\n"
         "• /top [week|month|all] — топ игроков\n"
+        "• /history — мои выполнения; менеджеры: /history <code>&lt;@user|id&gt;</code>\n"
         "• /log <code>&lt;@user|id&gt; &lt;код|название&gt; [count]</code> — менеджеры учитывают выполнение\n"
-        "• /promote <code>&lt;id&gt;</code> — super admin назначает менеджера\n\n"
+        "• /promote <code>&lt;id&gt;</code> — super admin назначает менеджера\n"
+        "• /rebuild_top — super admin пересчитывает топ недели/месяца\n"
+        "• /reconcile [fix] — super admin сверяет XP с историей выполнений\n\n"
         "Подсказка: используйте кнопки под строкой ввода, они вставляют команды автоматически."
     )
-    with SessionLocal() as db:
-        u = ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
         await msg.answer(text, reply_markup=build_main_kb(is_manager(u)))
 
 @router.message(Command("log_help"))
@@ -93,46 +121,119 @@ async def cmd_log_help(msg: Message):
         "Примеры:\n"
         "• <code>/log @username T001</code>\n"
         "• <code>/log 123456789 T005 3</code>\n"
-        "• <code>/log @username отзыв 2</code>"
+        "• <code>/log @username отзыв 2</code>\n"
+        "• <code>/log @username тайный гость</code>\n\n"
+        "Несколько записей сразу — каждая с новой строки после /log, "
+        "или файл CSV/XLSX (колонки: игрок, задание, количество) с подписью /log."
     )
 
 @router.message(Command("tasks"))
 async def cmd_tasks(msg: Message):
-    with SessionLocal() as db:
-        rows = list(db.scalars(select(Task).order_by(Task.code.asc())))
-        if not rows:
-            await msg.answer("Заданий пока нет.")
-            return
-        chunks = [f"<code>{t.code}</code> — {t.name} (+{t.xp} XP)" for t in rows]
-        await msg.answer("\n".join(chunks))
+    rows = task_index().tasks
+    if not rows:
+        await msg.answer("Заданий пока нет.")
+        return
+    chunks = [f"<code>{t.code}</code> — {t.name} (+{t.xp} XP)" for t in rows]
+    await msg.answer("\n".join(chunks))
 
 @router.message(Command("me"))
 async def cmd_me(msg: Message):
-    with SessionLocal() as db:
-        u = ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
-        prof = get_profile(db, u)
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+        prof = get_profile(u)
         lines = [f"XP: <b>{u.xp_total}</b>"]
         if prof.level:
             lines.append(f"Уровень: <b>{prof.level.num}</b> — {prof.level.title}")
         if prof.next_level:
             pct = int((prof.progress_to_next or 0) * 100)
             lines.append(f"Прогресс к {prof.next_level.num}: {pct}% ({u.xp_total}/{prof.next_level.xp_required})")
+        for period, title in (("all", "Место"), ("week", "Место за неделю")):
+            r = current_ranking(period)
+            place = r.rank(u.id)
+            if place is None:
+                continue
+            gap = r.gap_to_next(u.id)
+            tail = f", до следующего места {gap} XP" if gap is not None else ""
+            lines.append(f"{title}: <b>{place}</b> из {len(r)}{tail}")
         await msg.answer("\n".join(lines))
 
 @router.message(Command("top"))
 async def cmd_top(msg: Message):
     args = (msg.text or "").split()
     period = args[1] if len(args) >= 2 and args[1] in {"week", "month", "all"} else "week"
-    with SessionLocal() as db:
-        rows = leaderboard(db, period)
-        if not rows:
-            await msg.answer("Пока нет данных по топу.")
+    async with AsyncSessionLocal() as db:
+        s = await standing(db, period)
+    await msg.answer(s.text)
+
+HISTORY_PAGE = 10
+
+def _history_text(target: User | UserSnapshot, page) -> str:
+    name = target.full_name or target.username or target.tg_id
+    lines = [f"<b>История: {name}</b>"]
+    tasks = task_index().by_id
+    for s in page.items:
+        t = tasks.get(s.task_id)
+        title = t.name if t else f"задание #{s.task_id}"
+        lines.append(f"{local_time(s.created_at):%d.%m.%Y %H:%M} — {title} ×{s.count} (+{s.xp_awarded} XP)")
+    if page.rolled_until:
+        lines.append(f"<i>Выполнения по {page.rolled_until:%d.%m.%Y} свёрнуты в дневные итоги и здесь не показываются "
+                     f"(XP по ним учтён, подробности — в выгрузке).</i>")
+    elif not page.items:
+        lines.append("Выполнений пока нет.")
+    return "\n".join(lines)
+
+def _history_kb(user_id: int, page) -> InlineKeyboardMarkup | None:
+    """Кнопки листания. В callback_data — id крайних записей страницы (keyset-курсор)."""
+    buttons = []
+    if page.items and page.has_newer:
+        buttons.append(InlineKeyboardButton(text="← Новее", callback_data=f"hist:{user_id}:a:{page.items[0].id}"))
+    if page.items and page.has_older:
+        buttons.append(InlineKeyboardButton(text="Старее →", callback_data=f"hist:{user_id}:b:{page.items[-1].id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+@router.message(Command("history"))
+async def cmd_history(msg: Message):
+    args = (msg.text or "").split()
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+        target: User | UserSnapshot | None = u
+        if len(args) >= 2:
+            if not is_manager(u):
+                await msg.answer("Историю других игроков смотрят только менеджеры.")
+                return
+            target = await resolve_user(db, args[1])
+            if not target:
+                await msg.answer("Не найден пользователь. Формат: <code>/history &lt;@user|id&gt;</code>")
+                return
+        page = await history_page(db, target.id, limit=HISTORY_PAGE)
+        await msg.answer(_history_text(target, page), reply_markup=_history_kb(target.id, page))
+
+@router.callback_query(F.data.startswith("hist:"))
+async def cb_history(cb: CallbackQuery):
+    try:
+        _, user_id, direction, edge = cb.data.split(":")
+        user_id, edge = int(user_id), int(edge)
+    except ValueError:
+        await cb.answer()
+        return
+    async with AsyncSessionLocal() as db:
+        u = await ensure_user(db, cb.from_user.id, cb.from_user.username, cb.from_user.full_name)
+        if u.id != user_id and not is_manager(u):
+            await cb.answer("Недостаточно прав.", show_alert=True)
             return
-        lines = [f"<b>Топ ({period})</b>"]
-        for i, (u, total) in enumerate(rows[:10], start=1):
-            uname = u.full_name or ("@" + u.username if u.username else str(u.tg_id))
-            lines.append(f"{i}. {uname} — {total} XP")
-        await msg.answer("\n".join(lines))
+        target = await db.get(User, user_id)
+        if not target:
+            await cb.answer("Игрок не найден.", show_alert=True)
+            return
+        if direction == "a":
+            page = await history_page(db, user_id, after=edge, limit=HISTORY_PAGE)
+        else:
+            page = await history_page(db, user_id, before=edge, limit=HISTORY_PAGE)
+    if not page.items:
+        await cb.answer("Записей больше нет.")
+        return
+    await cb.message.edit_text(_history_text(target, page), reply_markup=_history_kb(user_id, page))
+    await cb.answer()
 
 @router.message(Command("promote"))
 async def cmd_promote(msg: Message):
@@ -148,70 +249,130 @@ async def cmd_promote(msg: Message):
     except ValueError:
         await msg.answer("ID должен быть числом.")
         return
-    with SessionLocal() as db:
-        u = db.scalar(select(User).where(User.tg_id == uid))
+    async with AsyncSessionLocal() as db:
+        u = await db.scalar(select(User).where(User.tg_id == uid))
         if not u:
             await msg.answer("Пользователь не найден (он должен написать боту /start).")
             return
         u.is_manager = True
-        db.commit()
+        await db.commit()
+        user_cache.invalidate(uid)
         await msg.answer(f"Назначен менеджером: {u.full_name or u.username or uid}")
 
+@router.message(Command("rebuild_top"))
+async def cmd_rebuild_top(msg: Message):
+    """Пересчёт недельных/месячных агрегатов XP из submissions (super admin)."""
+    if not settings.super_admin_id or msg.from_user.id != settings.super_admin_id:
+        await msg.answer("Недостаточно прав.")
+        return
+    async with AsyncSessionLocal() as db:
+        n = await rebuild_period_xp(db)
+    await msg.answer(f"Агрегаты топа пересчитаны: {n} строк.")
+
+@router.message(Command("reconcile"))
+async def cmd_reconcile(msg: Message):
+    """Сверка XP игроков с историей выполнений (super admin). /reconcile fix — исправить расхождения."""
+    if not settings.super_admin_id or msg.from_user.id != settings.super_admin_id:
+        await msg.answer("Недостаточно прав.")
+        return
+    fix = (msg.text or "").split()[1:2] == ["fix"]
+    async with AsyncSessionLocal() as db:
+        drift = await reconcile_xp(db, fix=fix)
+    if not drift:
+        await msg.answer("Расхождений XP нет.")
+        return
+    lines = [f"Расхождений: <b>{len(drift)}</b>" + (" (исправлено)" if fix else " — /reconcile fix, чтобы исправить")]
+    lines += [f"• {d.tg_id}: в профиле {d.stored}, по истории {d.actual}" for d in drift[:20]]
+    await msg.answer("\n".join(lines))
+
 @router.message(Command("log"))
 async def cmd_log(msg: Message):
-    from .models import User  # локальный импорт, чтобы не было колец
-    with SessionLocal() as db:
-        manager = ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
-        if not (manager.is_manager or manager.tg_id in settings.manager_id_set):
+    async with AsyncSessionLocal() as db:
+        manager = await ensure_user(db, msg.from_user.id, msg.from_user.username, msg.from_user.full_name)
+        if not is_manager(manager):
             await msg.answer("Команда доступна только менеджерам.")
             return
-        parts = (msg.text or "").split(maxsplit=3)
-        if len(parts) < 3:
+        # пакетный режим: документ CSV/XLSX с подписью /log или несколько строк
+        if msg.document:
+            if (msg.document.file_size or 0) > MAX_DOCUMENT_BYTES:
+                await msg.answer("Файл слишком большой (максимум 1 МБ).")
+                return
+            data = await msg.bot.download(msg.document)
+            entries, bad = parse_log_document(data.read(), msg.document.file_name or "")
+            await _log_bulk(msg, db, manager, entries, bad, _log_key(msg))
+            return
+        text = msg.text or ""
+        if "\n" in text.strip():
+            entries, bad = parse_log_text(text)
+            await _log_bulk(msg, db, manager, entries, bad, _log_key(msg))
+            return
+        entry = parse_log_line(text.split(maxsplit=1)[1] if len(text.split()) > 1 else "")
+        if not entry:
             await msg.answer("Формат: <code>/log &lt;@user|id&gt; &lt;код|часть названия&gt; [count]</code>")
             return
-        who_raw, task_raw = parts[1], parts[2]
-        count = 1
-        if len(parts) >= 4:
-            try:
-                count = max(1, int(parts[3]))
-            except ValueError:
-                pass
-        # user resolve
-        target = None
-        if who_raw.startswith("@"):
-            username = who_raw[1:]
-            target = db.scalar(select(User).where(User.username == username))
-        else:
-            try:
-                tid = int(who_raw)
-                target = db.scalar(select(User).where(User.tg_id == tid))
-            except ValueError:
-                pass
+        task_raw, count = entry.task, entry.count
+        target = await resolve_user(db, entry.who)
         if not target:
             await msg.answer("Не найден пользователь. Он должен сначала написать /start боту.")
             return
-        task = find_task(db, task_raw)
+        task = find_task(task_raw)
         if not task:
-            await msg.answer("Задание не найдено. Посмотрите /tasks")
+            options = task_index().search(task_raw)
+            if not options:
+                await msg.answer("Задание не найдено. Посмотрите /tasks")
+                return
+            lines = ["Уточните задание — укажите код:"]
+            lines += [f"<code>{m.task.code}</code> — {m.task.name}" for m in options]
+            await msg.answer("\n".join(lines))
+            return
+        try:
+            sub, new_xp = await award(db, target, task, count, manager, idempotency_key=_log_key(msg))
+        except AlreadyApplied:
+            await msg.answer(ALREADY_APPLIED)
             return
-        old_prof = get_profile(db, target)
-        sub = award(db, target, task, count, manager)
-        new_prof = get_profile(db, target)
         text = (
-            f"Зачтено: <b>{task.name}</b> ×{count} (+{task.xp*count} XP)\n"
+            f"Зачтено: <b>{task.name}</b> ×{count} (+{sub.xp_awarded} XP)\n"
             f"Игрок: {target.full_name or target.username or target.tg_id}\n"
-            f"Итого XP: <b>{target.xp_total}</b>"
+            f"Итого XP: <b>{new_xp}</b>"
         )
-        if (new_prof.level and not old_prof.level) or (
-            new_prof.level and old_prof.level and new_prof.level.num != old_prof.level.num
-        ):
-            text += (
-                f"\n🎉 Новый уровень: <b>{new_prof.level.num}</b> — {new_prof.level.title}! "
-                f"Награда: {new_prof.level.reward}"
-            )
-            try:
-                await bot.send_message(target.tg_id, "Поздравляем! У тебя новый уровень! Посмотри /me")
-            except Exception:
-                pass
+        # все уровни, пройденные этим начислением (может быть несколько сразу);
+        # старый итог считаем от нового из БД — верно и при параллельных начислениях
+        crossed = level_index().crossed(new_xp - sub.xp_awarded, new_xp)
+        for lev in crossed:
+            text += f"\n🎉 Новый уровень: <b>{lev.num}</b> — {lev.title}! Награда: {lev.reward}"
+        if crossed:
+            outbox.send(target.tg_id, "Поздравляем! У тебя новый уровень! Посмотри /me")
         await msg.answer(text)
 
+
+ALREADY_APPLIED = "Это сообщение уже зачтено — повторно XP не начисляется."
+
+def _log_key(msg: Message) -> str:
+    """Ключ идемпотентности /log: одно сообщение — одно начисление, сколько бы раз Telegram его ни прислал."""
+    return f"{msg.chat.id}:{msg.message_id}"
+
+async def _log_bulk(msg: Message, db, manager: UserSnapshot, entries: list[LogEntry], bad: list[int], key: str | None = None):
+    """Пакетный /log: одна транзакция, один итоговый ответ, уведомления о уровнях — разом в outbox."""
+    if not entries:
+        await msg.answer("Не найдено ни одной записи. Формат строки: <code>&lt;@user|id&gt; &lt;код|название&gt; [count]</code>")
+        return
+    try:
+        res = await award_bulk(db, entries, manager, idempotency_key=key)
+    except AlreadyApplied:
+        await msg.answer(ALREADY_APPLIED)
+        return
+    errors = [f"строка {i}: не разобрана" for i in bad] + res.errors
+    lines = [f"Зачтено записей: <b>{len(res.applied)}</b> из {len(entries) + len(bad)}"]
+    for snap, xp, total in res.totals.values():
+        lines.append(f"• {snap.full_name or snap.username or snap.tg_id}: +{xp} XP (итого {total})")
+    for snap, crossed in res.level_ups:
+        top = crossed[-1]
+        lines.append(f"🎉 {snap.full_name or snap.username or snap.tg_id}: уровень <b>{top.num}</b> — {top.title}! "
+                     f"Награда: {', '.join(str(l.reward) for l in crossed)}")
+        outbox.send(snap.tg_id, "Поздравляем! У тебя новый уровень! Посмотри /me")
+    if errors:
+        lines.append("\n<b>Не зачтено:</b>")
+        lines += [escape(e) for e in errors[:20]]
+        if len(errors) > 20:
+            lines.append(f"… и ещё {len(errors) - 20}")
+    await msg.answer("\n".join(lines))
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import asyncio, sys
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, insert, update, bindparam, func
+from .config import settings
+from .db import AsyncSessionLocal
+from .models import Broadcast, BroadcastDelivery
+from .standings import standing, render_heroes
+from .bot import outbox
+
+# Рассылки в несколько чатов: текст сохраняется один раз, доставка в каждый чат — отдельной
+# строкой со статусом. Отправка идёт параллельно через outbox (лимиты Telegram соблюдаются там),
+# неудачные доставки переотправляет retry_failed().
+
+SEND_TIMEOUT = 600.0  # сек на всю волну отправки; не дождались — failed, переотправится
+RETRY_WINDOW = timedelta(days=1)  # старше суток не переотправляем — рассылка уже неактуальна
+
+
+async def _send(deliveries: list[tuple[int, int]], text: str) -> tuple[int, int]:
+    """Отправить текст в чаты и записать статусы. deliveries — (id доставки, chat_id).
+    Возвращает (доставлено, не доставлено)."""
+    async def one(chat_id: int) -> str | None:
+        try:
+            return await asyncio.wait_for(outbox.deliver(chat_id, text), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            return "timeout"
+
+    errors = await asyncio.gather(*(one(chat_id) for _, chat_id in deliveries))
+    d_t = BroadcastDelivery.__table__
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(d_t).where(d_t.c.id == bindparam("b_id")).values(
+                status=bindparam("b_status"), error=bindparam("b_error"),
+                attempts=d_t.c.attempts + 1, updated_at=func.now()),
+            [{"b_id": did, "b_status": "sent" if err is None else "failed", "b_error": (err or None) and err[:255]}
+             for (did, _), err in zip(deliveries, errors)],
+        )
+        await db.commit()
+    for (_, chat_id), err in zip(deliveries, errors):
+        if err is not None:
+            print("Broadcast failed:", chat_id, err, file=sys.stderr)
+    failed = sum(err is not None for err in errors)
+    return len(errors) - failed, failed
+
+
+async def publish(kind: str, text: str, chats: list[int]) -> int:
+    """Сохранить рассылку и доставки (pending) и разослать. Возвращает id рассылки."""
+    async with AsyncSessionLocal() as db:
+        b = Broadcast(kind=kind, text=text)
+        db.add(b)
+        await db.flush()
+        ids = await db.scalars(
+            insert(BroadcastDelivery).returning(BroadcastDelivery.id, sort_by_parameter_order=True),
+            [{"broadcast_id": b.id, "chat_id": c, "status": "pending", "attempts": 0} for c in chats],
+        )
+        deliveries = list(zip(ids.all(), chats))
+        await db.commit()
+        broadcast_id = b.id
+    sent, failed = await _send(deliveries, text)
+    print(f"Broadcast {kind} #{broadcast_id}: sent {sent}, failed {failed}", file=sys.stderr)
+    return broadcast_id
+
+
+async def retry_failed() -> int:
+    """Переотправить недоставленное за последние сутки, не больше BROADCAST_RETRIES раз на чат."""
+    since = datetime.now(timezone.utc) - RETRY_WINDOW
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(
+            select(BroadcastDelivery.id, BroadcastDelivery.chat_id, Broadcast.id, Broadcast.text)
+            .join(Broadcast, Broadcast.id == BroadcastDelivery.broadcast_id)
+            .where(BroadcastDelivery.status == "failed",
+                   BroadcastDelivery.attempts <= settings.broadcast_retries,
+                   Broadcast.created_at >= since)
+            .order_by(Broadcast.id, BroadcastDelivery.id)
+        )).all()
+    by_broadcast: dict[int, tuple[str, list[tuple[int, int]]]] = {}
+    for did, chat_id, bid, text in rows:
+        by_broadcast.setdefault(bid, (text, []))[1].append((did, chat_id))
+    for text, deliveries in by_broadcast.values():
+        await _send(deliveries, text)
+    return len(rows)
+
+
+async def broadcast_heroes() -> int | None:
+    """Герои недели и месяца во все чаты рассылки. Снимок топа — общий с /top (см. standings)."""
+    chats = settings.broadcast_chats
+    if not chats:
+        return None
+    async with AsyncSessionLocal() as db:
+        week = await standing(db, "week")
+        month = await standing(db, "month")
+    return await publish("heroes", render_heroes(week, month), chats)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+import csv, io
+from dataclasses import dataclass
+
+# Разбор записей /log: одна запись — «<@user|id> <код|название> [count]».
+# Источники: строки сообщения или документ CSV/XLSX (колонки: игрок, задание, количество).
+
+MAX_DOCUMENT_BYTES = 1 << 20
+MAX_COUNT = 1000  # больше — почти наверняка опечатка; заодно xp_awarded/xp_total не переполнят INTEGER
+
+@dataclass(frozen=True)
+class LogEntry:
+    line: int  # номер строки в сообщении/файле — для сообщений об ошибках
+    who: str
+    task: str
+    count: int = 1
+
+
+def parse_int(value: str) -> int | None:
+    """Целое из строки или None. Не isdigit(): он пропускает «²», на котором int() падает."""
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_log_line(text: str, line: int = 1) -> LogEntry | None:
+    """«@user тайный гость 2» -> LogEntry. Название может быть из нескольких слов,
+    count — последнее слово, если это число; больше MAX_COUNT — запись не разбирается."""
+    words = text.split()
+    if len(words) < 2:
+        return None
+    who, task_words = words[0], words[1:]
+    count = 1
+    if len(task_words) >= 2 and task_words[-1].isdecimal():
+        count = max(1, int(task_words.pop()))
+        if count > MAX_COUNT:
+            return None
+    return LogEntry(line=line, who=who, task=" ".join(task_words), count=count)
+
+
+def _looks_like_user(value: str) -> bool:
+    return value.startswith("@") or parse_int(value) is not None
+
+def _entry_from_cells(cells: list, line: int) -> LogEntry | None:
+    cells = [("" if c is None else str(int(c)) if isinstance(c, float) and c.is_integer() else str(c)).strip() for c in cells]
+    if len(cells) < 2 or not cells[0] or not cells[1]:
+        return None
+    count = 1
+    if len(cells) >= 3 and cells[2]:
+        try:
+            count = max(1, int(float(cells[2])))
+        except (ValueError, OverflowError):  # «abc», nan, inf
+            return None
+        if count > MAX_COUNT:
+            return None
+    return LogEntry(line=line, who=cells[0], task=cells[1], count=count)
+
+
+def parse_log_text(text: str) -> tuple[list[LogEntry], list[int]]:
+    """Многострочный /log. Первая строка — команда (возможно, сразу с первой записью).
+    Возвращает записи и номера строк, которые не удалось разобрать."""
+    entries: list[LogEntry] = []
+    bad: list[int] = []
+    for i, raw in enumerate(text.splitlines(), start=1):
+        if i == 1:
+            raw = raw.split(maxsplit=1)[1] if len(raw.split(maxsplit=1)) > 1 else ""
+        if not raw.strip():
+            continue
+        e = parse_log_line(raw, i)
+        if e: entries.append(e)
+        else: bad.append(i)
+    return entries, bad
+
+
+def parse_log_document(data: bytes, filename: str) -> tuple[list[LogEntry], list[int]]:
+    """CSV (разделитель , ; или табуляция) или XLSX. Строка заголовка пропускается автоматически."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            rows = [list(r) for r in wb.worksheets[0].iter_rows(values_only=True)]
+        finally:
+            wb.close()
+    else:
+        try:
+            text = data.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            text = data.decode("cp1251")
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        rows = list(csv.reader(io.StringIO(text), dialect))
+    entries: list[LogEntry] = []
+    bad: list[int] = []
+    for i, cells in enumerate(rows, start=1):
+        if not any(c not in (None, "") for c in cells):
+            continue
+        e = _entry_from_cells(cells, i)
+        if e and _looks_like_user(e.who):
+            entries.append(e)
+        elif i > 1:  # первая непарсящаяся строка — заголовок
+            bad.append(i)
+    return entries, bad
@@ -1,6 +1,7 @@
 from __future__ import annotations
 import os
 from pydantic import BaseModel
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 class Settings(BaseModel):
     telegram_token: str = os.getenv("TELEGRAM_TOKEN", "")
@@ -10,7 +11,67 @@ class Settings(BaseModel):
     super_admin_id: int | None = int(os.getenv("SUPER_ADMIN_ID", "0")) or None
     database_url: str = os.getenv("DATABASE_URL", "sqlite:///./plg.sqlite3")
     broadcast_chat_id: int | None = int(os.getenv("BROADCAST_CHAT_ID", "0")) or None
+    broadcast_chat_ids: str = os.getenv("BROADCAST_CHAT_IDS", "")  # доп. чаты/каналы через запятую
     timezone: str = os.getenv("TZ", "Europe/Helsinki")
+    # пул соединений (Postgres; для SQLite-файла — только размер пула) и прагмы SQLite
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    db_pool_timeout: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    db_pool_recycle: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", "1") not in ("0", "false", "no")
+    sqlite_journal_mode: str = os.getenv("SQLITE_JOURNAL_MODE", "wal")
+    sqlite_synchronous: str = os.getenv("SQLITE_SYNCHRONOUS", "normal")
+    sqlite_busy_timeout_ms: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    # очередь апдейтов вебхука: число воркеров, ёмкость, сколько ждать места перед 503
+    update_workers: int = int(os.getenv("UPDATE_WORKERS", "4"))
+    update_queue_size: int = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+    update_put_timeout: float = float(os.getenv("UPDATE_PUT_TIMEOUT", "2"))
+    # кэш пользователей: размер, TTL записи (сек), период сброса смены имён в БД (сек)
+    user_cache_size: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    user_cache_ttl: float = float(os.getenv("USER_CACHE_TTL", "300"))
+    user_flush_interval: float = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+    # исходящие сообщения: общий лимит (сообщ./сек), интервал в чат (личка/группа), повторы
+    outbox_rate: float = float(os.getenv("OUTBOX_RATE", "25"))
+    outbox_chat_interval: float = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1"))
+    outbox_group_interval: float = float(os.getenv("OUTBOX_GROUP_INTERVAL", "3"))
+    outbox_workers: int = int(os.getenv("OUTBOX_WORKERS", "4"))
+    outbox_size: int = int(os.getenv("OUTBOX_SIZE", "10000"))
+    outbox_max_attempts: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    # доля апдейтов, которые пишутся в лог (0 — не писать, 1 — все); пишется только сводка без текста
+    log_update_sample: float = float(os.getenv("LOG_UPDATE_SAMPLE", "0"))
+    # аренды в БД: лидер планировщика (сек) и максимальное ожидание импорта другим воркером (сек)
+    leader_lease_ttl: float = float(os.getenv("LEADER_LEASE_TTL", "30"))
+    import_lease_timeout: float = float(os.getenv("IMPORT_LEASE_TIMEOUT", "120"))
+    # свёртка submissions: строки старше N дней сворачиваются в дневные итоги (0 — не сворачивать, по умолчанию);
+    # archive — переносить сырые строки в submissions_archive (по умолчанию), 0 — удалять
+    rollup_after_days: int = int(os.getenv("ROLLUP_AFTER_DAYS", "0"))
+    rollup_batch: int = int(os.getenv("ROLLUP_BATCH", "5000"))
+    rollup_archive: bool = os.getenv("ROLLUP_ARCHIVE", "1") in ("1", "true", "yes")
+    # токен выгрузок /export/* (пусто — выгрузки выключены) и размер пачки строк при стриминге
+    export_token: str = os.getenv("EXPORT_TOKEN", "")
+    # токен API профилей игроков /api/users/* (пусто — профили по API выключены)
+    api_token: str = os.getenv("API_TOKEN", "")
+    export_chunk: int = int(os.getenv("EXPORT_CHUNK", "1000"))
+    # рассылки: сколько раз переотправлять в чат, куда доставка не удалась (раз в 10 минут)
+    broadcast_retries: int = int(os.getenv("BROADCAST_RETRIES", "3"))
+    # дедупликация апдейтов вебхука: сколько update_id помнить в памяти и сколько секунд — в БД
+    dedup_window: int = int(os.getenv("DEDUP_WINDOW", "10000"))
+    dedup_ttl: float = float(os.getenv("DEDUP_TTL", "86400"))
+    # как часто (сек) пересобирать рейтинги в памяти из БД — подтянуть начисления других воркеров
+    ranking_refresh_interval: float = float(os.getenv("RANKING_REFRESH_INTERVAL", "60"))
+
+    @property
+    def broadcast_chats(self) -> list[int]:
+        """BROADCAST_CHAT_ID и BROADCAST_CHAT_IDS без повторов, в порядке перечисления."""
+        chats: list[int] = [self.broadcast_chat_id] if self.broadcast_chat_id else []
+        for chunk in self.broadcast_chat_ids.split(","):
+            try:
+                chat = int(chunk.strip())
+            except ValueError:
+                continue
+            if chat not in chats:
+                chats.append(chat)
+        return chats
 
     @property
     def manager_id_set(self) -> set[int]:
@@ -27,4 +88,11 @@ class Settings(BaseModel):
             ids.add(self.super_admin_id)
         return ids
 
+def safe_tz(name: str) -> ZoneInfo:
+    """Фолбэк на UTC, если TZ задана неверно (чтобы сервис не падал)."""
+    try:
+        return ZoneInfo(name)
+    except ZoneInfoNotFoundError:
+        return ZoneInfo("UTC")
+
 settings = Settings()
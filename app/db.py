@@ -1,14 +1,148 @@
 from __future__ import annotations
-from sqlalchemy import create_engine
+import time
+from dataclasses import dataclass
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url, Engine, URL
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 from .config import settings
 
 class Base(DeclarativeBase):
     pass
 
-engine = create_engine(
-    settings.database_url,
-    echo=False,
-    future=True,
-)
+# асинхронные драйверы для известных диалектов (sqlite -> aiosqlite, postgresql -> asyncpg)
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+def async_url(url: str) -> URL:
+    """Тот же DATABASE_URL, но с асинхронным драйвером для AsyncEngine."""
+    u = make_url(url)
+    backend = u.get_backend_name()
+    driver = ASYNC_DRIVERS.get(backend)
+    if not driver:
+        return u
+    u = u.set(drivername=f"{backend}+{driver}")
+    if driver == "asyncpg" and "sslmode" in u.query:
+        # ?sslmode=require (libpq, его понимает psycopg2) asyncpg не знает — у него тот же режим в ssl
+        mode = u.query["sslmode"]
+        u = u.difference_update_query(["sslmode"])
+        if "ssl" not in u.query:
+            u = u.update_query_dict({"ssl": mode})
+    return u
+
+def dialect_insert(db: AsyncSession):
+    """insert() с поддержкой ON CONFLICT для текущего диалекта (SQLite/Postgres)."""
+    return postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+
+@dataclass(frozen=True)
+class EngineProfile:
+    """Настройки пула и SQLite-прагм. Что применимо — выбирается по схеме URL."""
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30.0
+    pool_recycle: int = 1800  # сек; хостинги рвут простаивающие соединения к Postgres
+    pool_pre_ping: bool = True
+    sqlite_journal_mode: str = "wal"  # читатели не ждут писателя
+    sqlite_synchronous: str = "normal"  # в WAL безопасно и намного быстрее full
+    sqlite_busy_timeout_ms: int = 5000
+
+    @classmethod
+    def from_settings(cls) -> EngineProfile:
+        return cls(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=settings.db_pool_pre_ping,
+            sqlite_journal_mode=settings.sqlite_journal_mode,
+            sqlite_synchronous=settings.sqlite_synchronous,
+            sqlite_busy_timeout_ms=settings.sqlite_busy_timeout_ms,
+        )
+
+    def engine_kwargs(self, url: str | URL) -> dict:
+        u = make_url(url)
+        if u.get_backend_name() == "sqlite":
+            if u.database in (None, "", ":memory:"):
+                return {}  # StaticPool/SingletonThreadPool — параметры пула не применимы
+            return {"pool_size": self.pool_size, "max_overflow": self.max_overflow, "pool_timeout": self.pool_timeout}
+        return {
+            "pool_size": self.pool_size,
+            "max_overflow": self.max_overflow,
+            "pool_timeout": self.pool_timeout,
+            "pool_recycle": self.pool_recycle,
+            "pool_pre_ping": self.pool_pre_ping,
+        }
+
+    def install(self, sync_engine: Engine) -> None:
+        """Прагмы SQLite на каждое новое соединение (для AsyncEngine передавайте .sync_engine)."""
+        if sync_engine.dialect.name != "sqlite":
+            return
+
+        @event.listens_for(sync_engine, "connect")
+        def _pragmas(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            cur.execute(f"PRAGMA busy_timeout={int(self.sqlite_busy_timeout_ms)}")
+            if self.sqlite_journal_mode:
+                cur.execute(f"PRAGMA journal_mode={self.sqlite_journal_mode}")
+            if self.sqlite_synchronous:
+                cur.execute(f"PRAGMA synchronous={self.sqlite_synchronous}")
+            cur.close()
+
+def make_engine(url: str, profile: EngineProfile) -> Engine:
+    eng = create_engine(url, echo=False, future=True, **profile.engine_kwargs(url))
+    profile.install(eng)
+    return eng
+
+def make_async_engine(url: str, profile: EngineProfile) -> AsyncEngine:
+    aurl = async_url(url)
+    eng = create_async_engine(aurl, echo=False, **profile.engine_kwargs(aurl))
+    profile.install(eng.sync_engine)
+    return eng
+
+ENGINE_PROFILE = EngineProfile.from_settings()
+
+# синхронный движок — только для старта (create_all, импорт Excel), не для хендлеров
+engine = make_engine(settings.database_url, ENGINE_PROFILE)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# асинхронный движок — для хендлеров бота и фоновых задач в event loop
+async_engine = make_async_engine(settings.database_url, ENGINE_PROFILE)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False,
+)
+
+def _add_missing_columns() -> None:
+    """Добавить в существующие таблицы новые колонки модели — nullable или с server_default
+    (create_all их не добавляет)."""
+    insp = inspect(engine)
+    existing = set(insp.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            have = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in have or not (col.nullable or col.server_default is not None):
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=engine.dialect)}'
+                if col.server_default is not None:
+                    ddl += f' DEFAULT {col.server_default.arg.compile(dialect=engine.dialect)}'
+                conn.execute(text(ddl))
+
+def create_schema(attempts: int = 5) -> None:
+    """Создать таблицы, недостающие nullable-колонки и индексы (create_all не меняет старые таблицы).
+    Несколько воркеров стартуют одновременно: проигравший гонку получает «already exists» —
+    повторяем, и checkfirst уже видит созданное."""
+    for attempt in range(attempts):
+        try:
+            Base.metadata.create_all(bind=engine)
+            _add_missing_columns()
+            for table in Base.metadata.sorted_tables:
+                for ix in table.indexes:
+                    ix.create(bind=engine, checkfirst=True)
+            return
+        except (OperationalError, ProgrammingError, IntegrityError):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.5 * (attempt + 1))
@@ -0,0 +1,66 @@
+from __future__ import annotations
+import sys, time
+from collections import OrderedDict
+from sqlalchemy import delete
+from .db import AsyncSessionLocal, dialect_insert
+from .models import ProcessedUpdate
+
+
+class UpdateDedup:
+    """Окно уже принятых update_id: последние window штук в памяти, все за ttl секунд — в БД.
+
+    Память отвечает на повторы в этом воркере без запросов; таблица processed_updates —
+    на повторы, пришедшие в другой воркер или после рестарта (вставка с ON CONFLICT DO NOTHING).
+    Если БД недоступна — пропускаем апдейт дальше: лучше редкий дубль, чем потерянный апдейт.
+    """
+
+    def __init__(self, window: int = 10000, ttl: float = 86400.0):
+        self.window = window
+        self.ttl = ttl
+        self._recent: OrderedDict[int, None] = OrderedDict()
+        self.duplicates = 0
+
+    def _remember(self, update_id: int) -> None:
+        self._recent[update_id] = None
+        self._recent.move_to_end(update_id)
+        while len(self._recent) > self.window:
+            self._recent.popitem(last=False)
+
+    async def seen(self, update_id: int) -> bool:
+        """Отметить апдейт принятым. True — он уже был принят раньше (дубль)."""
+        if update_id in self._recent:
+            self.duplicates += 1
+            return True
+        try:
+            async with AsyncSessionLocal() as db:
+                ins = dialect_insert(db)
+                stmt = (ins(ProcessedUpdate).values(update_id=update_id, seen_at=time.time())
+                        .on_conflict_do_nothing(index_elements=[ProcessedUpdate.update_id])
+                        .returning(ProcessedUpdate.update_id))
+                fresh = await db.scalar(stmt)
+                await db.commit()
+        except Exception as e:
+            print("Dedup check failed:", update_id, e, file=sys.stderr)
+            return False
+        self._remember(update_id)
+        if fresh is None:
+            self.duplicates += 1
+            return True
+        return False
+
+    async def forget(self, update_id: int) -> None:
+        """Снять отметку — апдейт не принят (очередь полна), Telegram пришлёт его снова."""
+        self._recent.pop(update_id, None)
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.update_id == update_id))
+            await db.commit()
+
+    async def prune(self) -> int:
+        """Удалить из БД отметки старше ttl."""
+        async with AsyncSessionLocal() as db:
+            res = await db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.seen_at < time.time() - self.ttl))
+            await db.commit()
+        return res.rowcount or 0
+
+    def stats(self) -> dict:
+        return {"window": len(self._recent), "duplicates": self.duplicates}
@@ -0,0 +1,186 @@
+from __future__ import annotations
+import asyncio, csv, hmac, io, json, tempfile
+from datetime import date, datetime, timedelta
+from typing import AsyncIterator, Literal
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+from .config import settings
+from .db import AsyncSessionLocal
+from .models import User, Task, Submission, SubmissionRollup, XpPeriod
+from .logic import day_start_utc, local_time, period_bucket
+
+# Выгрузки для HR: журнал выполнений и срезы топа в CSV / XLSX / JSON Lines.
+# Строки читаются из БД потоком (серверный курсор, yield_per) и отдаются пачками —
+# память постоянна при любом объёме, а event loop бота не блокируется.
+
+Format = Literal["csv", "xlsx", "jsonl"]
+MEDIA = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "jsonl": "application/x-ndjson",
+}
+
+router = APIRouter(prefix="/export")
+
+
+def check_token(expected: str, token: str | None, authorization: str | None, what: str) -> None:
+    """?token=... или Authorization: Bearer ... Пустой expected — эндпоинты what выключены (404)."""
+    if not expected:
+        raise HTTPException(status_code=404, detail=f"{what} disabled")
+    given = token or (authorization or "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(given.encode(), expected.encode()):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+def require_token(token: str | None = None, authorization: str | None = Header(default=None)) -> None:
+    """EXPORT_TOKEN. Без токена в настройках выгрузки выключены."""
+    check_token(settings.export_token, token, authorization, "export")
+
+# --- кодирование -----------------------------------------------------------------
+
+def _text(v):
+    if isinstance(v, datetime):
+        return local_time(v).isoformat(timespec="seconds")
+    if isinstance(v, date):
+        return v.isoformat()
+    return v
+
+def _xlsx_cell(v):
+    return local_time(v).replace(tzinfo=None) if isinstance(v, datetime) else v  # Excel не знает TZ
+
+async def _chunks(rows: AsyncIterator[tuple], size: int) -> AsyncIterator[list[tuple]]:
+    chunk: list[tuple] = []
+    async for r in rows:
+        chunk.append(tuple(r))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+async def _csv(header: list[str], rows: AsyncIterator[tuple]) -> AsyncIterator[bytes]:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    buf.write("\ufeff")  # BOM: Excel открывает кириллицу без танцев с кодировкой
+    w.writerow(header)
+    async for chunk in _chunks(rows, settings.export_chunk):
+        w.writerows([_text(v) for v in r] for r in chunk)
+        yield buf.getvalue().encode()
+        buf.seek(0); buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode()
+
+async def _jsonl(header: list[str], rows: AsyncIterator[tuple]) -> AsyncIterator[bytes]:
+    async for chunk in _chunks(rows, settings.export_chunk):
+        yield "".join(json.dumps(dict(zip(header, map(_text, r))), ensure_ascii=False) + "\n" for r in chunk).encode()
+
+async def _xlsx(header: list[str], rows: AsyncIterator[tuple]) -> AsyncIterator[bytes]:
+    """write_only-книга держит строки во временном файле; запись и сохранение — в потоке,
+    затем готовый файл отдаётся кусками."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(header)
+
+    def append(chunk: list[tuple]) -> None:
+        for r in chunk:
+            ws.append([_xlsx_cell(v) for v in r])
+
+    async for chunk in _chunks(rows, settings.export_chunk):
+        await asyncio.to_thread(append, chunk)
+    with tempfile.TemporaryFile() as f:
+        await asyncio.to_thread(wb.save, f)
+        f.seek(0)
+        while data := await asyncio.to_thread(f.read, 1 << 16):
+            yield data
+
+ENCODERS = {"csv": _csv, "xlsx": _xlsx, "jsonl": _jsonl}
+
+def _response(name: str, fmt: Format, header: list[str], rows: AsyncIterator[tuple]) -> StreamingResponse:
+    return StreamingResponse(
+        ENCODERS[fmt](header, rows), media_type=MEDIA[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+async def _stream(*queries) -> AsyncIterator[tuple]:
+    """Строки запросов подряд из одной сессии; каждый — серверным курсором пачками по EXPORT_CHUNK."""
+    async with AsyncSessionLocal() as db:
+        for q in queries:
+            result = await db.stream(q.execution_options(yield_per=settings.export_chunk))
+            async for row in result:
+                yield row
+
+# --- эндпоинты -------------------------------------------------------------------------
+
+SUBMISSION_COLUMNS = ["source", "id", "created_at", "player_tg_id", "player_username", "player_name",
+                      "task_code", "task_name", "count", "xp", "manager_tg_id", "manager_name", "rows"]
+
+@router.get("/submissions", dependencies=[Depends(require_token)])
+async def export_submissions(fmt: Format = "csv", since: date | None = None, until: date | None = None,
+                             rollups: bool = Query(True, description="включать свёрнутые по дням старые выполнения")):
+    """Журнал выполнений с игроками, заданиями и менеджерами. since/until — локальные даты, включительно.
+    Старые выполнения (свёрнутые в дневные итоги) идут первыми, source=rollup, rows — сколько строк в итоге."""
+    player, manager = aliased(User), aliased(User)
+    raw = (select(
+        Submission.id, Submission.created_at, player.tg_id, player.username, player.full_name,
+        Task.code, Task.name, Submission.count, Submission.xp_awarded, manager.tg_id, manager.full_name)
+        .join(player, Submission.user_id == player.id)
+        .join(Task, Submission.task_id == Task.id)
+        .outerjoin(manager, Submission.manager_id == manager.id)
+        .order_by(Submission.id))
+    if since:
+        raw = raw.where(Submission.created_at >= day_start_utc(since))
+    if until:
+        raw = raw.where(Submission.created_at < day_start_utc(until + timedelta(days=1)))
+    queries = []
+    if rollups:
+        rolled = (select(
+            SubmissionRollup.id, SubmissionRollup.day, player.tg_id, player.username, player.full_name,
+            Task.code, Task.name, SubmissionRollup.count, SubmissionRollup.xp, manager.tg_id, manager.full_name,
+            SubmissionRollup.submissions)
+            .join(player, SubmissionRollup.user_id == player.id)
+            .join(Task, SubmissionRollup.task_id == Task.id)
+            .outerjoin(manager, SubmissionRollup.manager_id == manager.id)
+            .order_by(SubmissionRollup.day, SubmissionRollup.id))
+        if since:
+            rolled = rolled.where(SubmissionRollup.day >= since)
+        if until:
+            rolled = rolled.where(SubmissionRollup.day <= until)
+        queries.append(rolled)
+    queries.append(raw)
+
+    async def rows():
+        async for r in _stream(*queries):
+            yield ("rollup", *r) if len(r) == 12 else ("raw", *r, 1)
+
+    return _response("submissions", fmt, SUBMISSION_COLUMNS, rows())
+
+
+LEADERBOARD_COLUMNS = ["rank", "tg_id", "username", "full_name", "xp"]
+
+@router.get("/leaderboard", dependencies=[Depends(require_token)])
+async def export_leaderboard(period: Literal["week", "month", "all"] = "week", fmt: Format = "csv",
+                             on: date | None = Query(None, description="любой день нужной недели/месяца; по умолчанию текущий")):
+    """Срез топа: все игроки периода по убыванию XP. Для week/month — по агрегатам xp_periods,
+    для all — по users.xp_total. Место общее при равном XP."""
+    if period == "all":
+        q = select(User.tg_id, User.username, User.full_name, User.xp_total).order_by(User.xp_total.desc(), User.id)
+        name = "leaderboard-all"
+    else:
+        bucket = period_bucket(period, day_start_utc(on) if on else None)
+        q = (select(User.tg_id, User.username, User.full_name, XpPeriod.xp)
+             .join(XpPeriod, XpPeriod.user_id == User.id)
+             .where(XpPeriod.period == period, XpPeriod.bucket == bucket)
+             .order_by(XpPeriod.xp.desc(), User.id))
+        name = f"leaderboard-{period}-{bucket.isoformat()}"
+
+    async def rows():
+        rank, prev, i = 0, None, 0
+        async for r in _stream(q):
+            i += 1
+            if r[-1] != prev:
+                rank, prev = i, r[-1]
+            yield (rank, *r)
+
+    return _response(name, fmt, LEADERBOARD_COLUMNS, rows())
@@ -1,15 +1,23 @@
 from __future__ import annotations
-import os, re
-import pandas as pd
-from sqlalchemy import delete
+import hashlib, math, os, re
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+from sqlalchemy import select, delete
 from sqlalchemy.orm import Session
-from .models import Task, Level
+from .models import Task, Level, Submission, SubmissionRollup, ImportState
+from .levels import load_levels
+from .search import load_tasks, normalize
+from .logic import bump_data_version
 
 TASKS_FILES = ["data/Банк Заданий .xlsx", "data/Bank Zadanii.xlsx"]
 LEVELS_FILES = ["data/Уровни и награды.xlsx", "data/Levels.xlsx"]
 
+# меняйте при изменении логики разбора — это сбросит отпечатки и форсирует импорт
+IMPORT_VERSION = "3"
+
 def _num(val) -> int:
-    if pd.isna(val): return 0
+    if val is None or (isinstance(val, float) and math.isnan(val)): return 0
     if isinstance(val, (int, float)): return int(val)
     m = re.search(r"\d+", str(val))
     return int(m.group(0)) if m else 0
@@ -39,41 +47,155 @@ DEFAULT_LEVELS = [
     (10, "Супергерой", 5000, "10000"),
 ]
 
-def import_tasks_levels(db: Session) -> tuple[int, int]:
-    db.execute(delete(Task)); db.execute(delete(Level))
-    # tasks
-    rows = None
+@dataclass
+class ImportReport:
+    tasks_skipped: bool = False
+    tasks_added: int = 0
+    tasks_changed: int = 0
+    tasks_removed: int = 0
+    tasks_kept: int = 0  # пропали из файла, но на них есть выполнения — в архив, не удаляем
+    levels_skipped: bool = False
+    levels_added: int = 0
+    levels_changed: int = 0
+    levels_removed: int = 0
+
+    def __str__(self) -> str:
+        t = "без изменений" if self.tasks_skipped else (
+            f"+{self.tasks_added} ~{self.tasks_changed} -{self.tasks_removed}"
+            + (f" (в архив {self.tasks_kept})" if self.tasks_kept else ""))
+        l = "без изменений" if self.levels_skipped else f"+{self.levels_added} ~{self.levels_changed} -{self.levels_removed}"
+        return f"задания: {t}; уровни: {l}"
+
+# --- источники -------------------------------------------------------------------
+
+def _fingerprint(paths: list[str], defaults) -> str:
+    """sha256 по содержимому всех существующих файлов-кандидатов (или по дефолтам)."""
+    h = hashlib.sha256(IMPORT_VERSION.encode())
+    found = False
+    for path in paths:
+        if os.path.exists(path):
+            found = True
+            h.update(path.encode())
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    h.update(chunk)
+    if not found:
+        h.update(repr(defaults).encode())
+    return h.hexdigest()
+
+@contextmanager
+def _sheet_rows(path: str) -> Iterator[tuple[list[str], Iterator[tuple]]]:
+    """Заголовок и построчный итератор первого листа (openpyxl read-only, без pandas).
+    Книга закрывается на выходе из with — и когда строки не читались (не тот заголовок)."""
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(c).strip() if c is not None else "" for c in next(rows, ())]
+        yield header, (r for r in rows if any(c is not None and str(c).strip() for c in r))
+    finally:
+        wb.close()
+
+def _col(header: list[str], prefix: str) -> int | None:
+    return next((i for i, c in enumerate(header) if c.lower().startswith(prefix)), None)
+
+def _cell(row: tuple, i: int):
+    return row[i] if i < len(row) else None
+
+def _read_tasks() -> list[tuple[str, int]]:
     for path in TASKS_FILES:
         if os.path.exists(path):
-            df = pd.read_excel(path, sheet_name=0)
-            df.columns = [str(c).strip() for c in df.columns]
-            name_col = next((c for c in df.columns if str(c).lower().startswith("название")), None)
-            xp_col = next((c for c in df.columns if str(c).lower().startswith("xp")), None)
-            if name_col and xp_col:
-                rows = [(str(r[name_col]).strip(), _num(r[xp_col])) for _, r in df.iterrows()]
-                break
-    if rows is None: rows = DEFAULT_TASKS
-    tasks = [Task(code=f"T{i:03d}", name=n, xp=int(x)) for i,(n,x) in enumerate(rows, start=1)]
-    db.add_all(tasks)
-    # levels
-    lev_rows = None
+            with _sheet_rows(path) as (header, rows):
+                name_col, xp_col = _col(header, "название"), _col(header, "xp")
+                if name_col is not None and xp_col is not None:
+                    return [(str(_cell(r, name_col)).strip(), _num(_cell(r, xp_col))) for r in rows]
+    return DEFAULT_TASKS
+
+def _read_levels() -> list[tuple[int, str, int, str]]:
     for path in LEVELS_FILES:
         if os.path.exists(path):
-            df = pd.read_excel(path, sheet_name=0)
-            df.columns = [str(c).strip() for c in df.columns]
-            need = {
-                "num": next((c for c in df.columns if str(c).lower().startswith("уровень")), None),
-                "title": next((c for c in df.columns if str(c).lower().startswith("звание")), None),
-                "xp_required": next((c for c in df.columns if str(c).lower().startswith("xp")), None),
-                "reward": next((c for c in df.columns if str(c).lower().startswith("награда")), None),
-            }
-            if all(need.values()):
-                lev_rows = [
-                    (_num(r[need["num"]]), str(r[need["title"]]).strip(), _num(r[need["xp_required"]]), str(r[need["reward"]]).strip())
-                    for _, r in df.iterrows()
-                ]
-                break
-    if lev_rows is None: lev_rows = DEFAULT_LEVELS
-    db.add_all([Level(num=int(n), title=t, xp_required=int(x), reward=r) for n,t,x,r in lev_rows])
+            with _sheet_rows(path) as (header, rows):
+                need = [_col(header, "уровень"), _col(header, "звание"), _col(header, "xp"), _col(header, "награда")]
+                if all(c is not None for c in need):
+                    n, t, x, r = need
+                    return [
+                        (_num(_cell(row, n)), str(_cell(row, t)).strip(), _num(_cell(row, x)), str(_cell(row, r)).strip())
+                        for row in rows
+                    ]
+    return DEFAULT_LEVELS
+
+# --- применение ------------------------------------------------------------------
+
+def _state(db: Session, name: str) -> ImportState | None:
+    return db.get(ImportState, name)
+
+def _mark(db: Session, name: str, digest: str) -> None:
+    st = _state(db, name)
+    if st: st.digest = digest
+    else: db.add(ImportState(name=name, digest=digest))
+
+def _sync_tasks(db: Session, rows: list[tuple[str, int]], rep: ImportReport) -> None:
+    """Задания сопоставляются по нормализованному названию, а не по позиции строки: вставка или удаление
+    строки в середине листа не меняет id и коды остальных. Новые получают следующий свободный код.
+    Переименованное задание — новое, старое уходит в архив (или удаляется, если выполнений нет)."""
+    existing = list(db.scalars(select(Task)))
+    by_name = {normalize(t.name): t for t in existing}
+    seq = max((int(t.code[1:]) for t in existing if t.code[1:].isdecimal()), default=0)
+    wanted: set[str] = set()
+    for name, xp in rows:
+        key = normalize(name)
+        if not key or key in wanted:
+            continue
+        wanted.add(key)
+        t = by_name.get(key)
+        if not t:
+            seq += 1
+            db.add(Task(code=f"T{seq:03d}", name=name, xp=int(xp), active=True)); rep.tasks_added += 1
+        elif (t.name, t.xp, t.active) != (name, int(xp), True):
+            t.name, t.xp, t.active = name, int(xp), True; rep.tasks_changed += 1
+    gone = [t for key, t in by_name.items() if key not in wanted]
+    if gone:
+        ids = [t.id for t in gone]
+        used = set(db.scalars(select(Submission.task_id).where(Submission.task_id.in_(ids)).distinct()))
+        used |= set(db.scalars(select(SubmissionRollup.task_id).where(SubmissionRollup.task_id.in_(ids)).distinct()))
+        for t in gone:
+            if t.id not in used:
+                db.delete(t); rep.tasks_removed += 1
+            elif t.active:
+                t.active = False; rep.tasks_kept += 1
+
+def _sync_levels(db: Session, rows: list[tuple[int, str, int, str]], rep: ImportReport) -> None:
+    wanted = {int(n): (t, int(x), r) for n, t, x, r in rows}
+    existing = {l.num: l for l in db.scalars(select(Level))}
+    for num, (title, xp, reward) in wanted.items():
+        l = existing.get(num)
+        if not l:
+            db.add(Level(num=num, title=title, xp_required=xp, reward=reward)); rep.levels_added += 1
+        elif (l.title, l.xp_required, l.reward) != (title, xp, reward):
+            l.title, l.xp_required, l.reward = title, xp, reward; rep.levels_changed += 1
+    gone = [num for num in existing if num not in wanted]
+    if gone:
+        db.execute(delete(Level).where(Level.num.in_(gone))); rep.levels_removed += len(gone)
+
+def import_tasks_levels(db: Session, force: bool = False) -> ImportReport:
+    """Импорт заданий и уровней из Excel. Если файлы не менялись с прошлого раза — ничего не делает."""
+    rep = ImportReport()
+    tasks_digest = _fingerprint(TASKS_FILES, DEFAULT_TASKS)
+    st = _state(db, "tasks")
+    if not force and st and st.digest == tasks_digest:
+        rep.tasks_skipped = True
+    else:
+        _sync_tasks(db, _read_tasks(), rep)
+        _mark(db, "tasks", tasks_digest)
+    levels_digest = _fingerprint(LEVELS_FILES, DEFAULT_LEVELS)
+    st = _state(db, "levels")
+    if not force and st and st.digest == levels_digest:
+        rep.levels_skipped = True
+    else:
+        _sync_levels(db, _read_levels(), rep)
+        _mark(db, "levels", levels_digest)
     db.commit()
-    return len(tasks), len(lev_rows)
+    load_levels(db)
+    load_tasks(db)
+    bump_data_version()  # уровни в профилях и кэши API/топа — уже по новым данным
+    return rep
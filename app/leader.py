@@ -0,0 +1,79 @@
+from __future__ import annotations
+import asyncio, os, socket, sys, time, uuid
+from sqlalchemy import delete
+from .db import AsyncSessionLocal, dialect_insert
+from .models import Lease
+
+# один id на процесс: все аренды этого воркера держатся от его имени
+HOLDER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class LeaseHolder:
+    """Аренда роли через строку в таблице leases с временем истечения.
+
+    Захват/продление — один атомарный upsert: строка переписывается на нас, только если
+    аренда истекла или уже наша. Работает одинаково на SQLite и Postgres, между
+    воркерами uvicorn и между инстансами.
+    """
+
+    def __init__(self, name: str, ttl: float = 30.0, holder: str = HOLDER_ID):
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder
+        self._expires = 0.0
+        self._task: asyncio.Task | None = None
+
+    @property
+    def held(self) -> bool:
+        return time.time() < self._expires
+
+    async def acquire(self) -> bool:
+        """Захватить или продлить аренду. True — аренда наша ещё на ttl секунд."""
+        now = time.time()
+        async with AsyncSessionLocal() as db:
+            ins = dialect_insert(db)
+            stmt = ins(Lease).values(name=self.name, holder=self.holder, expires_at=now + self.ttl)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Lease.name],
+                set_={"holder": stmt.excluded.holder, "expires_at": stmt.excluded.expires_at},
+                where=(Lease.expires_at < now) | (Lease.holder == self.holder),
+            ).returning(Lease.holder)
+            got = await db.scalar(stmt)
+            await db.commit()
+        self._expires = now + self.ttl if got == self.holder else 0.0
+        return self.held
+
+    async def release(self) -> None:
+        self._expires = 0.0
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(Lease).where(Lease.name == self.name, Lease.holder == self.holder))
+            await db.commit()
+
+    async def wait(self, timeout: float, poll: float = 1.0) -> bool:
+        """Ждать аренду до timeout секунд (например, пока другой воркер закончит импорт)."""
+        deadline = time.monotonic() + timeout
+        while not await self.acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(poll)
+        return True
+
+    def start(self) -> None:
+        """Фоновое продление: лидер продлевает аренду, остальные периодически пробуют её взять."""
+        async def loop():
+            while True:
+                try:
+                    await self.acquire()
+                except Exception as e:
+                    self._expires = 0.0
+                    print(f"Lease {self.name} error:", e, file=sys.stderr)
+                await asyncio.sleep(self.ttl / 3)
+        self._task = asyncio.create_task(loop(), name=f"lease-{self.name}")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.held:
+            await self.release()
@@ -0,0 +1,62 @@
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterable
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .models import Level
+
+
+@dataclass(frozen=True)
+class LevelRow:
+    num: int
+    title: str
+    xp_required: int
+    reward: str | None
+
+
+@dataclass(frozen=True)
+class LevelIndex:
+    """Неизменяемая таблица уровней, отсортированная по порогу XP.
+    Уровень по XP ищется бинарным поиском, без запросов в БД."""
+    levels: tuple[LevelRow, ...] = ()
+    thresholds: tuple[int, ...] = ()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[LevelRow]) -> LevelIndex:
+        levels = tuple(sorted(rows, key=lambda r: r.xp_required))
+        return cls(levels=levels, thresholds=tuple(r.xp_required for r in levels))
+
+    def _pos(self, xp: int) -> int:
+        return bisect_right(self.thresholds, xp)
+
+    def current(self, xp: int) -> LevelRow | None:
+        i = self._pos(xp)
+        return self.levels[i - 1] if i else None
+
+    def next(self, xp: int) -> LevelRow | None:
+        i = self._pos(xp)
+        return self.levels[i] if i < len(self.levels) else None
+
+    def crossed(self, old_xp: int, new_xp: int) -> tuple[LevelRow, ...]:
+        """Уровни, пороги которых пройдены при переходе old_xp -> new_xp (по возрастанию)."""
+        return self.levels[self._pos(old_xp):self._pos(new_xp)]
+
+
+_index = LevelIndex()
+
+def level_index() -> LevelIndex:
+    return _index
+
+def set_levels(rows: Iterable[LevelRow]) -> LevelIndex:
+    """Подменить индекс целиком (атомарно — одной ссылкой)."""
+    global _index
+    _index = LevelIndex.from_rows(rows)
+    return _index
+
+def load_levels(db: Session) -> LevelIndex:
+    """Перечитать уровни из БД (на старте и после импорта)."""
+    return set_levels(
+        LevelRow(num=l.num, title=l.title, xp_required=l.xp_required, reward=l.reward)
+        for l in db.scalars(select(Level))
+    )
@@ -1,65 +1,372 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from sqlalchemy.orm import Session
-from sqlalchemy import select, func
+from dataclasses import dataclass, replace
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func, delete, insert, update, bindparam, tuple_
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 from typing import Literal
-from datetime import datetime, timezone
-from dateutil.relativedelta import relativedelta
-from .models import User, Task, Level, Submission
+from datetime import date, datetime, timezone, timedelta
+from .config import settings, safe_tz
+from .db import dialect_insert
+from .models import User, Task, Submission, SubmissionRollup, XpPeriod
+from .levels import LevelRow, level_index
+from .users import UserSnapshot, user_cache
+from .search import TaskRow, task_index
+from .bulk import LogEntry, parse_int
+from .ranking import Ranking, ranking, set_ranking
+
+PERIODS = ("week", "month")
+
+# Версия данных топа в процессе: растёт при каждом начислении и пересборке рейтингов.
+# По ней кэши отрендеренного топа понимают, что устарели.
+_data_version = 0
+
+def data_version() -> int:
+    return _data_version
+
+def bump_data_version() -> None:
+    global _data_version
+    _data_version += 1
+
+class AlreadyApplied(Exception):
+    """Выполнение с этим ключом идемпотентности уже зачтено — повтор того же апдейта."""
 
 @dataclass
 class Profile:
-    user: User
-    level: Level | None
-    next_level: Level | None
+    user: User | UserSnapshot
+    level: LevelRow | None
+    next_level: LevelRow | None
     progress_to_next: float | None  # 0..1
 
-def ensure_user(db: Session, tg_id: int, username: str | None, full_name: str | None) -> User:
-    u = db.scalar(select(User).where(User.tg_id == tg_id))
-    if u:
-        changed = False
-        if username and u.username != username: u.username = username; changed = True
-        if full_name and u.full_name != full_name: u.full_name = full_name; changed = True
-        if changed: db.commit()
-        return u
-    u = User(tg_id=tg_id, username=username, full_name=full_name, xp_total=0)
-    db.add(u); db.commit(); return u
-
-def get_profile(db: Session, user: User) -> Profile:
-    levels = list(db.scalars(select(Level).order_by(Level.xp_required.asc())))
-    current = None; nextl = None
-    for lev in levels:
-        if user.xp_total >= lev.xp_required: current = lev
-        elif not nextl: nextl = lev
+async def ensure_user(db: AsyncSession, tg_id: int, username: str | None, full_name: str | None) -> UserSnapshot:
+    """Снимок пользователя из кэша; в БД — только при промахе или для нового пользователя.
+    Смена имён уходит в БД пачкой в фоне (см. UserCache.flush)."""
+    snap = user_cache.get(tg_id)
+    if snap is None:
+        u = await db.scalar(select(User).where(User.tg_id == tg_id))
+        if not u:
+            u = User(tg_id=tg_id, username=username, full_name=full_name, xp_total=0)
+            db.add(u); await db.commit()
+            current_ranking("all").set(u.id, u.xp_total)
+        snap = user_cache.put(UserSnapshot.of(u))
+    if (username and snap.username != username) or (full_name and snap.full_name != full_name):
+        snap = user_cache.rename(snap, username, full_name)
+    return snap
+
+async def resolve_users(db: AsyncSession, whos: list[str]) -> dict[str, User]:
+    """«@username» или tg_id -> User, двумя запросами на весь список. Ненайденных в ответе нет."""
+    names = {w[1:] for w in whos if w.startswith("@")}
+    ids = {w: i for w in whos if not w.startswith("@") and (i := parse_int(w)) is not None}
+    by_name: dict[str, User] = {}
+    by_id: dict[int, User] = {}
+    if names:
+        by_name = {u.username: u for u in await db.scalars(select(User).where(User.username.in_(names)))}
+    if ids:
+        by_id = {u.tg_id: u for u in await db.scalars(select(User).where(User.tg_id.in_(set(ids.values()))))}
+    found = {w: by_name[w[1:]] for w in whos if w.startswith("@") and w[1:] in by_name}
+    found.update({w: by_id[i] for w, i in ids.items() if i in by_id})
+    return found
+
+async def resolve_user(db: AsyncSession, who: str) -> User | None:
+    """Игрок по аргументу команды: «@username» или tg_id."""
+    return (await resolve_users(db, [who])).get(who)
+
+def get_profile(user: User | UserSnapshot, xp: int | None = None) -> Profile:
+    """Профиль по XP игрока (или по явному xp) — из индекса уровней в памяти, без запросов."""
+    xp = user.xp_total if xp is None else xp
+    idx = level_index()
+    current = idx.current(xp); nextl = idx.next(xp)
     progress = None
     if current and nextl:
         span = max(1, nextl.xp_required - current.xp_required)
-        progress = (user.xp_total - current.xp_required) / span
+        progress = (xp - current.xp_required) / span
     elif not current and nextl:
-        progress = user.xp_total / max(1, nextl.xp_required)
+        progress = xp / max(1, nextl.xp_required)
     return Profile(user=user, level=current, next_level=nextl, progress_to_next=progress)
 
-def find_task(db: Session, query: str) -> Task | None:
-    query = query.strip().lower()
-    t = db.scalar(select(Task).where(func.lower(Task.code) == query))
-    if t: return t
-    return db.scalars(select(Task).where(func.lower(Task.name).like(f"%{query}%")).limit(1)).first()
+def find_task(query: str) -> TaskRow | None:
+    """Задание по коду или однозначному совпадению названия — из индекса в памяти."""
+    return task_index().best(query)
+
+def local_time(when: datetime | None = None) -> datetime:
+    """Момент when в локальной TZ."""
+    when = when or datetime.now(timezone.utc)
+    if when.tzinfo is None:  # SQLite отдаёт naive UTC
+        when = when.replace(tzinfo=timezone.utc)
+    return when.astimezone(safe_tz(settings.timezone))
+
+def local_day(when: datetime | None = None) -> date:
+    """Дата момента when в локальной TZ."""
+    return local_time(when).date()
+
+def day_start_utc(d: date) -> datetime:
+    """Полночь дня d в локальной TZ — в UTC (граница для фильтров по created_at)."""
+    return datetime.combine(d, datetime.min.time(), tzinfo=safe_tz(settings.timezone)).astimezone(timezone.utc)
+
+def day_bucket(period: str, d: date) -> date:
+    return d - timedelta(days=d.weekday()) if period == "week" else d.replace(day=1)
+
+def period_bucket(period: str, when: datetime | None = None) -> date:
+    """Первый день недели/месяца, в который попадает when (в локальной TZ)."""
+    return day_bucket(period, local_day(when))
+
+async def _add_period_xp(db: AsyncSession, xp_by_user: dict[int, int],
+                         when: datetime | None = None) -> dict[str, tuple[date, dict[int, int]]]:
+    """Прибавить XP в недельный и месячный агрегаты — один upsert на период для всех игроков.
+    Возвращает новые итоги: период -> (бакет, {user_id: xp})."""
+    out: dict[str, tuple[date, dict[int, int]]] = {}
+    if not xp_by_user:
+        return out
+    ins = dialect_insert(db)
+    for period in PERIODS:
+        bucket = period_bucket(period, when)
+        stmt = ins(XpPeriod).values([
+            {"user_id": uid, "period": period, "bucket": bucket, "xp": xp} for uid, xp in xp_by_user.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[XpPeriod.period, XpPeriod.bucket, XpPeriod.user_id],
+            set_={"xp": XpPeriod.xp + stmt.excluded.xp},
+        ).returning(XpPeriod.user_id, XpPeriod.xp)
+        out[period] = (bucket, dict((await db.execute(stmt)).all()))
+    return out
+
+def current_ranking(period: str) -> Ranking:
+    """Рейтинг периода в памяти; с началом новой недели/месяца — пустой."""
+    r = ranking(period)
+    bucket = None if period == "all" else period_bucket(period)
+    if r.bucket != bucket:
+        r = set_ranking(period, Ranking(bucket=bucket))
+    return r
 
-def award(db: Session, target_user: User, task: Task, count: int, manager: User | None) -> Submission:
+def _update_rankings(totals: dict[int, int], period_totals: dict[str, tuple[date, dict[int, int]]]) -> None:
+    """Записать новые итоги в рейтинги. Значения абсолютные (из RETURNING), поэтому повтор безопасен."""
+    bump_data_version()
+    r = current_ranking("all")
+    for uid, xp in totals.items():
+        r.set(uid, xp)
+    for period, (bucket, xp_by_user) in period_totals.items():
+        r = current_ranking(period)
+        if r.bucket == bucket:  # начисление пришлось на стык периодов — старый бакет уже не показываем
+            for uid, xp in xp_by_user.items():
+                r.set(uid, xp)
+
+async def load_rankings(db: AsyncSession) -> bool:
+    """Собрать рейтинги из users.xp_total и xp_periods (на старте, после пересчётов и периодически).
+    Версия данных растёт, только если что-то изменилось, — иначе кэш топа и ETag API остаются в силе.
+    True — рейтинги изменились."""
+    loaded = {"all": (None, dict((await db.execute(select(User.id, User.xp_total))).all()))}
+    for period in PERIODS:
+        bucket = period_bucket(period)
+        rows = await db.execute(select(XpPeriod.user_id, XpPeriod.xp)
+                                .where(XpPeriod.period == period, XpPeriod.bucket == bucket))
+        loaded[period] = (bucket, dict(rows.all()))
+    changed = False
+    for period, (bucket, scores) in loaded.items():
+        r = ranking(period)
+        if r.bucket != bucket or r.scores != scores:
+            set_ranking(period, Ranking(scores, bucket=bucket))
+            changed = True
+    if changed:
+        bump_data_version()
+    return changed
+
+async def credit_xp(db: AsyncSession, user_id: int, xp: int) -> int:
+    """Атомарно прибавить XP одним UPDATE ... RETURNING и вернуть новый итог.
+    Без read-modify-write в Python: параллельные начисления не теряются."""
+    return await db.scalar(
+        update(User).where(User.id == user_id).values(xp_total=User.xp_total + xp)
+        .returning(User.xp_total).execution_options(synchronize_session=False)
+    )
+
+async def award(db: AsyncSession, target_user: User | UserSnapshot, task: Task | TaskRow, count: int,
+                manager: User | UserSnapshot | None, idempotency_key: str | None = None) -> tuple[Submission, int]:
+    """Зачесть выполнение. Возвращает Submission и новый xp_total игрока (из БД, а не из объекта).
+    С idempotency_key повтор не начисляет ничего и поднимает AlreadyApplied."""
     total_xp = task.xp * max(1, count)
-    s = Submission(user_id=target_user.id, task_id=task.id, manager_id=manager.id if manager else None, count=count, xp_awarded=total_xp)
-    target_user.xp_total += total_xp
-    db.add(s); db.commit(); return s
+    s = Submission(user_id=target_user.id, task_id=task.id, manager_id=manager.id if manager else None, count=count,
+                   xp_awarded=total_xp, idempotency_key=idempotency_key)
+    db.add(s)
+    try:
+        await db.flush()  # сначала строка с уникальным ключом: на повторе падаем до начисления
+    except IntegrityError:
+        await db.rollback()
+        if idempotency_key:
+            raise AlreadyApplied(idempotency_key) from None
+        raise
+    new_total = await credit_xp(db, target_user.id, total_xp)
+    period_totals = await _add_period_xp(db, {target_user.id: total_xp})
+    await db.commit()
+    _update_rankings({target_user.id: new_total}, period_totals)
+    if isinstance(target_user, User):
+        set_committed_value(target_user, "xp_total", new_total)
+    user_cache.set_xp(target_user.tg_id, new_total)
+    return s, new_total
+
+@dataclass
+class BulkResult:
+    applied: list[tuple[LogEntry, TaskRow]]
+    errors: list[str]
+    totals: dict[int, tuple[UserSnapshot, int, int]]  # user_id -> (игрок, +XP, итого XP)
+    level_ups: list[tuple[UserSnapshot, tuple[LevelRow, ...]]]
+
+async def award_bulk(db: AsyncSession, entries: list[LogEntry], manager: User | UserSnapshot | None,
+                     idempotency_key: str | None = None) -> BulkResult:
+    """Начислить много записей одной транзакцией: игроки резолвятся двумя запросами,
+    задания — из индекса в памяти, XP прибавляется атомарно на стороне БД.
+    С idempotency_key каждая строка получает ключ «key:номер строки»; повтор поднимает AlreadyApplied."""
+    errors: list[str] = []
+    found = await resolve_users(db, [e.who for e in entries])
+    applied: list[tuple[LogEntry, TaskRow]] = []
+    rows: list[dict] = []
+    delta: dict[int, int] = {}
+    users: dict[int, User] = {}
+    for e in entries:
+        u = found.get(e.who)
+        if not u:
+            errors.append(f"строка {e.line}: не найден пользователь {e.who}")
+            continue
+        task = find_task(e.task)
+        if not task:
+            errors.append(f"строка {e.line}: задание не найдено или неоднозначно — «{e.task}»")
+            continue
+        xp = task.xp * e.count
+        rows.append({"user_id": u.id, "task_id": task.id, "manager_id": manager.id if manager else None,
+                     "count": e.count, "xp_awarded": xp,
+                     "idempotency_key": f"{idempotency_key}:{e.line}" if idempotency_key else None})
+        delta[u.id] = delta.get(u.id, 0) + xp
+        users[u.id] = u
+        applied.append((e, task))
+    totals: dict[int, tuple[UserSnapshot, int, int]] = {}
+    level_ups: list[tuple[UserSnapshot, tuple[LevelRow, ...]]] = []
+    if rows:
+        try:
+            await db.execute(insert(Submission), rows)
+        except IntegrityError:
+            await db.rollback()
+            if idempotency_key:
+                raise AlreadyApplied(idempotency_key) from None
+            raise
+        users_t = User.__table__
+        await db.execute(
+            update(users_t).where(users_t.c.id == bindparam("b_id"))
+            .values(xp_total=users_t.c.xp_total + bindparam("b_xp")),
+            [{"b_id": uid, "b_xp": xp} for uid, xp in delta.items()],
+        )
+        period_totals = await _add_period_xp(db, delta)
+        new_xp = dict((await db.execute(select(User.id, User.xp_total).where(User.id.in_(delta)))).all())
+        await db.commit()
+        _update_rankings(new_xp, period_totals)
+        for uid, xp in delta.items():
+            snap = replace(UserSnapshot.of(users[uid]), xp_total=new_xp[uid])
+            totals[uid] = (snap, xp, new_xp[uid])
+            user_cache.set_xp(snap.tg_id, new_xp[uid])
+            crossed = level_index().crossed(new_xp[uid] - xp, new_xp[uid])
+            if crossed:
+                level_ups.append((snap, crossed))
+    return BulkResult(applied=applied, errors=errors, totals=totals, level_ups=level_ups)
 
-def leaderboard(db: Session, period: Literal["week","month","all"]) -> list[tuple[User,int]]:
+async def leaderboard(db: AsyncSession, period: Literal["week","month","all"], limit: int | None = None) -> list[tuple[User,int]]:
+    """Топ за период. all — по User.xp_total, week/month — по агрегатам xp_periods."""
     if period == "all":
-        q = (select(User, func.coalesce(func.sum(Submission.xp_awarded), 0))
-             .join(Submission, isouter=True).group_by(User.id)
-             .order_by(func.coalesce(func.sum(Submission.xp_awarded), 0).desc()))
+        q = select(User, User.xp_total).order_by(User.xp_total.desc(), User.id)
     else:
-        now = datetime.now(timezone.utc)
-        start = (now - relativedelta(days=now.weekday())) if period == "week" else now.replace(day=1)
-        q = (select(User, func.coalesce(func.sum(Submission.xp_awarded), 0))
-             .join(Submission).where(Submission.created_at >= start)
-             .group_by(User.id).order_by(func.sum(Submission.xp_awarded).desc()))
-    return list(db.execute(q).all())
+        q = (select(User, XpPeriod.xp).join(XpPeriod, XpPeriod.user_id == User.id)
+             .where(XpPeriod.period == period, XpPeriod.bucket == period_bucket(period))
+             .order_by(XpPeriod.xp.desc(), User.id))
+    if limit:
+        q = q.limit(limit)
+    return list((await db.execute(q)).all())
+
+@dataclass
+class HistoryPage:
+    items: list[Submission]  # от новых к старым
+    has_newer: bool
+    has_older: bool
+    rolled_until: date | None = None  # на последней странице: до какого дня выполнения свёрнуты (см. rollups)
+
+async def history_page(db: AsyncSession, user_id: int, before: int | None = None, after: int | None = None,
+                       limit: int = 10) -> HistoryPage:
+    """Страница выполнений игрока, от новых к старым. Keyset-пагинация по (user_id, created_at, id):
+    before/after — id крайней записи соседней страницы, её created_at берётся подзапросом из БД
+    (так сравнение идёт с тем же значением, что хранится, без округлений при передаче).
+    Стоимость страницы не зависит от её номера."""
+    q = select(Submission).where(Submission.user_id == user_id)
+    key = tuple_(Submission.created_at, Submission.id)
+    if after is not None:  # страница новее записи after
+        edge = aliased(Submission)
+        q = q.where(key > tuple_(select(edge.created_at).where(edge.id == after).scalar_subquery(), after))
+        q = q.order_by(Submission.created_at, Submission.id)
+    else:
+        if before is not None:
+            edge = aliased(Submission)
+            q = q.where(key < tuple_(select(edge.created_at).where(edge.id == before).scalar_subquery(), before))
+        q = q.order_by(Submission.created_at.desc(), Submission.id.desc())
+    rows = list(await db.scalars(q.limit(limit + 1)))
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        return HistoryPage(items=rows[::-1], has_newer=more, has_older=True)
+    rolled_until = None
+    if not more:  # дальше сырых строк нет — подскажем, что более старые свёрнуты в дневные итоги
+        rolled_until = await db.scalar(select(func.max(SubmissionRollup.day)).where(SubmissionRollup.user_id == user_id))
+    return HistoryPage(items=rows, has_newer=before is not None, has_older=more, rolled_until=rolled_until)
+
+async def rebuild_period_xp(db: AsyncSession) -> int:
+    """Пересчитать xp_periods из submissions и дневных свёрток целиком. Возвращает число строк агрегата."""
+    totals: dict[tuple[str, date, int], int] = {}
+    rows = await db.stream(select(Submission.user_id, Submission.created_at, Submission.xp_awarded))
+    async for user_id, created_at, xp in rows:
+        day = local_day(created_at)
+        for period in PERIODS:
+            key = (period, day_bucket(period, day), user_id)
+            totals[key] = totals.get(key, 0) + xp
+    rows = await db.stream(select(SubmissionRollup.user_id, SubmissionRollup.day, SubmissionRollup.xp))
+    async for user_id, day, xp in rows:
+        for period in PERIODS:
+            key = (period, day_bucket(period, day), user_id)
+            totals[key] = totals.get(key, 0) + xp
+    await db.execute(delete(XpPeriod))
+    if totals:
+        await db.execute(insert(XpPeriod), [
+            {"period": p, "bucket": b, "user_id": u, "xp": xp} for (p, b, u), xp in totals.items()
+        ])
+    await db.commit()
+    await load_rankings(db)
+    return len(totals)
+
+async def period_xp_missing(db: AsyncSession) -> bool:
+    """Агрегат пуст, а выполнения есть — например, после обновления со старой схемы."""
+    has_agg = await db.scalar(select(XpPeriod.id).limit(1))
+    has_subs = await db.scalar(select(Submission.id).limit(1)) or await db.scalar(select(SubmissionRollup.id).limit(1))
+    return has_agg is None and has_subs is not None
+
+@dataclass
+class Drift:
+    user_id: int
+    tg_id: int
+    stored: int
+    actual: int
+
+async def reconcile_xp(db: AsyncSession, fix: bool = True) -> list[Drift]:
+    """Сверить users.xp_total с суммой submissions и дневных свёрток. Один запрос на всех игроков;
+    исправление — один UPDATE с коррелированным подзапросом (атомарно для каждой строки)."""
+    raw_q = (select(func.coalesce(func.sum(Submission.xp_awarded), 0))
+             .where(Submission.user_id == User.id).scalar_subquery())
+    rolled_q = (select(func.coalesce(func.sum(SubmissionRollup.xp), 0))
+                .where(SubmissionRollup.user_id == User.id).scalar_subquery())
+    actual_q = raw_q + rolled_q
+    rows = (await db.execute(
+        select(User.id, User.tg_id, User.xp_total, actual_q).where(User.xp_total != actual_q)
+    )).all()
+    drift = [Drift(user_id=r[0], tg_id=r[1], stored=r[2], actual=r[3]) for r in rows]
+    if fix and drift:
+        await db.execute(
+            update(User).where(User.xp_total != actual_q).values(xp_total=actual_q)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        for d in drift:
+            user_cache.invalidate(d.tg_id)
+        await load_rankings(db)
+    return drift
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import json, random, sys, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .config import settings
+
+if TYPE_CHECKING:  # aiogram тяжёлый — metrics нужен серверу до его загрузки
+    from aiogram.types import Update
+
+# Минимальный реестр метрик в формате Prometheus text exposition (без внешних зависимостей).
+# Метрики живут в процессе: при нескольких воркерах uvicorn каждый отдаёт свои.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{str(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name, self.doc, self.labelnames = name, doc, labels
+        self.values: dict[tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels: str, value: float = 1.0) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, labels, buckets
+        self.values: dict[tuple[str, ...], list] = {}  # labels -> [counts по бакетам..., sum, count]
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels: str) -> None:
+        v = self.values.get(labels)
+        if v is None:
+            v = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            v[i] += 1
+        v[-2] += value
+        v[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for k, v in self.values.items():
+            acc = 0
+            for b, c in zip(self.buckets, v):
+                acc += c
+                le = 'le="%s"' % b
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, k, le)} {acc}")
+            inf = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_labels(self.labelnames, k, inf)} {v[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, k)} {v[-2]}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, k)} {v[-1]}")
+        return out
+
+
+REGISTRY: list[Counter | Histogram] = []
+
+def render(gauges: dict[str, float] | None = None) -> str:
+    """Все метрики + мгновенные значения (глубина очередей и т.п.) в текстовом формате."""
+    lines: list[str] = []
+    for m in REGISTRY:
+        lines += m.render()
+    for name, value in (gauges or {}).items():
+        lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+
+http_seconds = Histogram("http_request_seconds", "HTTP request latency", ("route", "method", "status"))
+webhook_errors = Counter("webhook_errors_total", "Webhook requests that failed validation", ())
+webhook_duplicates = Counter("webhook_duplicates_total", "Webhook updates acknowledged as duplicates", ())
+command_seconds = Histogram("bot_command_seconds", "Bot handler latency", ("handler",))
+command_errors = Counter("bot_command_errors_total", "Bot handler exceptions", ("handler",))
+update_db_queries = Histogram("bot_update_db_queries", "DB queries per handled update", ("handler",),
+                              buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50))
+update_db_seconds = Histogram("bot_update_db_seconds", "DB time per handled update", ("handler",))
+db_queries = Counter("db_queries_total", "DB queries executed", ())
+
+# --- БД: счётчик запросов и времени для текущего апдейта ---------------------------
+
+_db_stats: ContextVar[list | None] = ContextVar("db_stats", default=None)  # [queries, seconds]
+
+def instrument_engine(engine: Engine) -> None:
+    """Подписаться на события движка: считать запросы и их время (для AsyncEngine — .sync_engine)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        db_queries.inc()
+        stats = _db_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+@contextmanager
+def track_db():
+    """Считать запросы к БД в текущем контексте (апдейте): отдаёт [число, сек]."""
+    stats = [0, 0.0]
+    token = _db_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _db_stats.reset(token)
+
+# --- логирование апдейтов ----------------------------------------------------------------
+
+def log_update(update: Update) -> None:
+    """Сэмплированный структурированный лог апдейта без содержимого сообщений (LOG_UPDATE_SAMPLE)."""
+    if settings.log_update_sample <= 0 or random.random() >= settings.log_update_sample:
+        return
+    try:
+        kind = update.event_type
+        ev = update.event
+    except Exception:
+        kind, ev = "unknown", None
+    user = getattr(ev, "from_user", None)
+    text = getattr(ev, "text", None) or ""
+    record = {
+        "event": "update",
+        "update_id": update.update_id,
+        "type": kind,
+        "user_id": user.id if user else None,
+        "command": text.split(maxsplit=1)[0].split("@")[0] if text.startswith("/") else None,
+        "text_len": len(text),
+    }
+    print(json.dumps(record, ensure_ascii=False), file=sys.stderr)
@@ -0,0 +1,51 @@
+from __future__ import annotations
+import argparse, hashlib
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from .db import Base, engine, SessionLocal, create_schema
+from .models import ImportState
+
+# Явный шаг миграции схемы. Отпечаток применённой схемы хранится в import_state (name="schema"):
+# если модели не менялись, рестарт обходится одним SELECT вместо create_all и проверки всех индексов.
+# Запуск при деплое: python -m app.migrate [--force]; сервер вызывает migrate() при старте.
+
+SCHEMA_STATE = "schema"
+
+def schema_digest() -> str:
+    """Отпечаток схемы моделей: DDL всех таблиц и индексов для диалекта текущей БД."""
+    h = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        h.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for ix in sorted(table.indexes, key=lambda i: i.name or ""):
+            h.update(str(CreateIndex(ix).compile(dialect=engine.dialect)).encode())
+    return h.hexdigest()
+
+def applied_digest() -> str | None:
+    if not inspect(engine).has_table(ImportState.__tablename__):
+        return None
+    with SessionLocal() as db:
+        st = db.get(ImportState, SCHEMA_STATE)
+        return st.digest if st else None
+
+def migrate(force: bool = False) -> bool:
+    """Привести схему БД к моделям, если она менялась с прошлой миграции. True — миграция выполнялась."""
+    digest = schema_digest()
+    if not force and applied_digest() == digest:
+        return False
+    create_schema()
+    with SessionLocal() as db:
+        st = db.get(ImportState, SCHEMA_STATE)
+        if st: st.digest = digest
+        else: db.add(ImportState(name=SCHEMA_STATE, digest=digest))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()  # соседний воркер записал отпечаток раньше — схема та же
+    return True
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Миграция схемы БД")
+    ap.add_argument("--force", action="store_true", help="проверить схему, даже если отпечаток совпадает")
+    args = ap.parse_args()
+    print("Schema migrated" if migrate(force=args.force) else "Schema up to date")
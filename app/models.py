@@ -1,6 +1,6 @@
 from __future__ import annotations
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import Integer, String, BigInteger, DateTime, ForeignKey, func
+from sqlalchemy import Boolean, Float, Integer, String, Text, BigInteger, Date, DateTime, ForeignKey, Index, UniqueConstraint, func, true
 from .db import Base
 
 class User(Base):
@@ -10,7 +10,7 @@ class User(Base):
     username: Mapped[str | None] = mapped_column(String(255))
     full_name: Mapped[str | None] = mapped_column(String(255))
     is_manager: Mapped[bool] = mapped_column(default=False)
-    xp_total: Mapped[int] = mapped_column(Integer, default=0)
+    xp_total: Mapped[int] = mapped_column(Integer, default=0, index=True)
 
 class Task(Base):
     __tablename__ = "tasks"
@@ -18,6 +18,9 @@ class Task(Base):
     code: Mapped[str] = mapped_column(String(16), unique=True, index=True)
     name: Mapped[str] = mapped_column(String(512))
     xp: Mapped[int] = mapped_column(Integer)
+    # пропало из банка заданий, но есть выполнения: строка остаётся для истории и выгрузок,
+    # в /tasks и /log его нет
+    active: Mapped[bool] = mapped_column(Boolean, server_default=true())
 
 class Level(Base):
     __tablename__ = "levels"
@@ -28,10 +31,100 @@ class Level(Base):
 
 class Submission(Base):
     __tablename__ = "submissions"
+    __table_args__ = (
+        # история игрока по страницам (keyset): WHERE user_id = ? AND (created_at, id) < (...)
+        Index("ix_submissions_user_created", "user_id", "created_at", "id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
     task_id: Mapped[int] = mapped_column(ForeignKey("tasks.id"))
     manager_id: Mapped[int | None] = mapped_column(ForeignKey("users.id"))
     count: Mapped[int] = mapped_column(Integer, default=1)
     xp_awarded: Mapped[int] = mapped_column(Integer)
-    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # ключ идемпотентности (чат:сообщение[:строка] для /log): повтор того же апдейта не начислит XP дважды
+    idempotency_key: Mapped[str | None] = mapped_column(String(64), unique=True, index=True)
+
+class SubmissionRollup(Base):
+    """Старые выполнения, свёрнутые по дням: один ряд на (день, игрок, задание, менеджер).
+    day — дата в локальной TZ. Сырые строки старше горизонта удаляются (см. rollups.py)."""
+    __tablename__ = "submission_rollups"
+    __table_args__ = (
+        Index("ix_submission_rollups_day", "day"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    day: Mapped[Date] = mapped_column(Date)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    task_id: Mapped[int] = mapped_column(ForeignKey("tasks.id"), index=True)
+    manager_id: Mapped[int | None] = mapped_column(ForeignKey("users.id"))
+    count: Mapped[int] = mapped_column(Integer, default=0)  # сумма submissions.count
+    xp: Mapped[int] = mapped_column(Integer, default=0)  # сумма submissions.xp_awarded
+    submissions: Mapped[int] = mapped_column(Integer, default=0)  # сколько сырых строк свёрнуто
+
+class SubmissionArchive(Base):
+    """Сырые выполнения, вынесенные из submissions при свёртке (если ROLLUP_ARCHIVE=1). id сохраняется."""
+    __tablename__ = "submissions_archive"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    user_id: Mapped[int] = mapped_column(Integer)
+    task_id: Mapped[int] = mapped_column(Integer)
+    manager_id: Mapped[int | None] = mapped_column(Integer)
+    count: Mapped[int] = mapped_column(Integer)
+    xp_awarded: Mapped[int] = mapped_column(Integer)
+    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True))
+
+class XpPeriod(Base):
+    """XP игрока за неделю/месяц. bucket — первый день периода в локальной TZ.
+    Обновляется в award() в той же транзакции, что и Submission."""
+    __tablename__ = "xp_periods"
+    __table_args__ = (
+        UniqueConstraint("period", "bucket", "user_id"),
+        Index("ix_xp_periods_top", "period", "bucket", "xp"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    period: Mapped[str] = mapped_column(String(8))  # week | month
+    bucket: Mapped[Date] = mapped_column(Date)
+    xp: Mapped[int] = mapped_column(Integer, default=0)
+
+class ImportState(Base):
+    """Отпечаток исходных файлов последнего импорта (tasks/levels) — чтобы не импортировать повторно."""
+    __tablename__ = "import_state"
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    digest: Mapped[str] = mapped_column(String(64))
+    updated_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class Lease(Base):
+    """Аренда с истечением: кто из воркеров/инстансов сейчас держит роль (планировщик, импорт)."""
+    __tablename__ = "leases"
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(128))
+    expires_at: Mapped[float] = mapped_column(Float)  # unix time
+
+class Broadcast(Base):
+    """Разосланный снимок (например, герои недели/месяца): текст хранится как был отправлен."""
+    __tablename__ = "broadcasts"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(String(16))
+    text: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class BroadcastDelivery(Base):
+    """Доставка рассылки в один чат: pending -> sent | failed (failed переотправляется)."""
+    __tablename__ = "broadcast_deliveries"
+    __table_args__ = (
+        UniqueConstraint("broadcast_id", "chat_id"),
+        Index("ix_broadcast_deliveries_status", "status"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    broadcast_id: Mapped[int] = mapped_column(ForeignKey("broadcasts.id"))
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    status: Mapped[str] = mapped_column(String(8), default="pending")
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[str | None] = mapped_column(String(255))
+    updated_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class ProcessedUpdate(Base):
+    """update_id вебхука, уже принятые в обработку (общее окно дедупликации для всех воркеров)."""
+    __tablename__ = "processed_updates"
+    update_id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    seen_at: Mapped[float] = mapped_column(Float, index=True)  # unix time
@@ -0,0 +1,140 @@
+from __future__ import annotations
+import asyncio, sys, time
+from dataclasses import dataclass, field
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+
+@dataclass
+class OutMessage:
+    chat_id: int
+    text: str
+    kwargs: dict = field(default_factory=dict)
+    attempt: int = 0
+    done: asyncio.Future | None = None  # результат для deliver(): None — доставлено, иначе ошибка
+
+
+class Outbox:
+    """Очередь исходящих сообщений поверх Bot.
+
+    Соблюдает лимиты Telegram: общий (rate сообщений в секунду на бота) и по чату
+    (личка — chat_interval, группы/каналы — group_interval секунд между сообщениями).
+    На 429 ждёт retry_after (пауза для всех чатов), на сетевых/5xx — повтор с backoff.
+    Хендлеры вызывают send() и не ждут отправки.
+    """
+
+    def __init__(self, bot: Bot | None, rate: float = 25.0, chat_interval: float = 1.0, group_interval: float = 3.0,
+                 workers: int = 4, maxsize: int = 10000, max_attempts: int = 5, backoff: float = 1.0):
+        self.bot = bot
+        self.global_interval = 1.0 / max(rate, 0.1)
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.workers = max(1, workers)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.queue: asyncio.Queue[OutMessage] = asyncio.Queue(maxsize=maxsize)
+        self.tasks: list[asyncio.Task] = []
+        self._global_next = 0.0
+        self._chat_next: dict[int, float] = {}
+        self._chat_locks: dict[int, list] = {}  # chat_id -> [Lock, сколько сообщений ждут]
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def send(self, chat_id: int, text: str, **kwargs) -> bool:
+        """Поставить сообщение в очередь. False — очередь переполнена, сообщение отброшено."""
+        try:
+            self.queue.put_nowait(OutMessage(chat_id, text, kwargs))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print("Outbox full, dropped message to", chat_id, file=sys.stderr)
+            return False
+
+    async def deliver(self, chat_id: int, text: str, **kwargs) -> str | None:
+        """Отправить через очередь (с теми же лимитами) и дождаться итога.
+        None — доставлено, иначе текст ошибки."""
+        done = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait(OutMessage(chat_id, text, kwargs, done=done))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return "outbox full"
+        return await done
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker(), name=f"outbox-{i}") for i in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "sent": self.sent, "retried": self.retried, "dropped": self.dropped}
+
+    async def _slot(self, chat_id: int) -> None:
+        """Зарезервировать ближайший момент, разрешённый и общим лимитом, и лимитом чата."""
+        now = time.monotonic()
+        interval = self.chat_interval if chat_id > 0 else self.group_interval
+        at = max(now, self._global_next, self._chat_next.get(chat_id, 0.0))
+        self._global_next = at + self.global_interval
+        self._chat_next[chat_id] = at + interval
+        if len(self._chat_next) > 10000:  # не копим старые чаты бесконечно
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _deliver(self, m: OutMessage) -> str | None:
+        while True:
+            await self._slot(m.chat_id)
+            m.attempt += 1
+            try:
+                await self.bot.send_message(m.chat_id, m.text, **m.kwargs)
+                self.sent += 1
+                return None
+            except TelegramRetryAfter as e:
+                # флуд-контроль действует на весь бот — притормаживаем все отправки
+                self._global_next = max(self._global_next, time.monotonic() + e.retry_after)
+                delay, error = 0.0, str(e)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                delay, error = self.backoff * 2 ** (m.attempt - 1), str(e)
+            except Exception as e:
+                # 400/403 и т.п. — повтор не поможет
+                self.dropped += 1
+                print("Outbox drop:", m.chat_id, e, file=sys.stderr)
+                return str(e)
+            if m.attempt >= self.max_attempts:
+                self.dropped += 1
+                print("Outbox drop after retries:", m.chat_id, file=sys.stderr)
+                return error
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def _deliver_in_order(self, m: OutMessage) -> str | None:
+        """Сообщения одного чата — строго по очереди (asyncio.Lock отдаёт ожидающим в порядке FIFO)."""
+        entry = self._chat_locks.setdefault(m.chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self._deliver(m)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[m.chat_id]
+
+    async def _worker(self) -> None:
+        while True:
+            m = await self.queue.get()
+            error: str | None = "cancelled"
+            try:
+                error = await self._deliver_in_order(m)
+            finally:
+                if m.done and not m.done.done():
+                    m.done.set_result(error)
+                self.queue.task_done()
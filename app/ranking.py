@@ -0,0 +1,73 @@
+from __future__ import annotations
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from datetime import date
+
+
+@dataclass(frozen=True)
+class Place:
+    rank: int  # 1 — первое место; при равном XP место общее
+    user_id: int
+    xp: int
+
+
+class Ranking:
+    """Упорядоченный рейтинг одного периода: отсортированный список ключей (-xp, user_id).
+
+    Место, отрыв до следующего и топ-k — бинарным поиском, без запросов в БД. Обновление — сдвиг
+    в списке (memmove), на сотнях тысяч игроков это микросекунды.
+    bucket — первый день недели/месяца, к которому относятся очки (для all — None).
+    """
+
+    def __init__(self, scores: dict[int, int] | None = None, bucket: date | None = None):
+        self.bucket = bucket
+        self.scores: dict[int, int] = dict(scores or {})
+        self._keys: list[tuple[int, int]] = sorted((-xp, uid) for uid, xp in self.scores.items())
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def set(self, user_id: int, xp: int) -> None:
+        """Записать итог игрока (идемпотентно: значение — абсолютное, не прибавка)."""
+        old = self.scores.get(user_id)
+        if old == xp:
+            return
+        if old is not None:
+            i = bisect_left(self._keys, (-old, user_id))
+            del self._keys[i]
+        self.scores[user_id] = xp
+        insort(self._keys, (-xp, user_id))
+
+    def _greater(self, xp: int) -> int:
+        """Сколько игроков набрали строго больше xp."""
+        return bisect_left(self._keys, (-xp,))
+
+    def rank(self, user_id: int) -> int | None:
+        xp = self.scores.get(user_id)
+        return None if xp is None else self._greater(xp) + 1
+
+    def gap_to_next(self, user_id: int) -> int | None:
+        """Сколько XP не хватает до ближайшего игрока выше. None — игрок первый или не в рейтинге."""
+        xp = self.scores.get(user_id)
+        if xp is None:
+            return None
+        above = self._greater(xp)
+        return -self._keys[above - 1][0] - xp if above else None
+
+    def _place(self, i: int) -> Place:
+        neg_xp, uid = self._keys[i]
+        return Place(rank=self._greater(-neg_xp) + 1, user_id=uid, xp=-neg_xp)
+
+    def top(self, k: int) -> list[Place]:
+        return [self._place(i) for i in range(min(k, len(self._keys)))]
+
+
+_rankings: dict[str, Ranking] = {}
+
+def ranking(period: str) -> Ranking:
+    return _rankings.setdefault(period, Ranking())
+
+def set_ranking(period: str, r: Ranking) -> Ranking:
+    """Подменить рейтинг периода целиком (атомарно — одной ссылкой)."""
+    _rankings[period] = r
+    return r
@@ -0,0 +1,92 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from sqlalchemy import select, insert, update, delete, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from .config import settings
+from .models import Submission, SubmissionRollup, SubmissionArchive
+from .logic import local_day, day_start_utc
+
+# Свёртка старых выполнений: submissions старше горизонта превращаются в дневные итоги
+# (день, игрок, задание, менеджер) в submission_rollups, сырые строки удаляются или архивируются.
+# XP игроков и агрегаты топа не меняются — суммы те же, меняется только гранулярность истории.
+
+@dataclass
+class CompactReport:
+    cutoff: date  # свёрнуто всё до этого дня (не включая)
+    raw_rows: int = 0
+    rollups_added: int = 0
+    rollups_merged: int = 0
+
+    def __str__(self) -> str:
+        return (f"до {self.cutoff:%d.%m.%Y}: строк {self.raw_rows}, "
+                f"итогов +{self.rollups_added} ~{self.rollups_merged}")
+
+
+def cutoff_day(after_days: int) -> date:
+    return local_day() - timedelta(days=after_days)
+
+
+async def _compact_batch(db: AsyncSession, before: datetime, batch: int, archive: bool, rep: CompactReport) -> int:
+    rows = (await db.execute(
+        select(Submission.id, Submission.user_id, Submission.task_id, Submission.manager_id,
+               Submission.count, Submission.xp_awarded, Submission.created_at)
+        .where(Submission.created_at < before).order_by(Submission.id).limit(batch)
+    )).all()
+    if not rows:
+        return 0
+    # (день, игрок, задание, менеджер) -> [count, xp, строк]
+    sums: dict[tuple[date, int, int, int | None], list[int]] = {}
+    for _, user_id, task_id, manager_id, count, xp, created_at in rows:
+        s = sums.setdefault((local_day(created_at), user_id, task_id, manager_id), [0, 0, 0])
+        s[0] += count; s[1] += xp; s[2] += 1
+    days = [k[0] for k in sums]
+    existing = {
+        (r.day, r.user_id, r.task_id, r.manager_id): r.id
+        for r in (await db.execute(
+            select(SubmissionRollup.id, SubmissionRollup.day, SubmissionRollup.user_id,
+                   SubmissionRollup.task_id, SubmissionRollup.manager_id)
+            .where(SubmissionRollup.day >= min(days), SubmissionRollup.day <= max(days))
+        )).all()
+    }
+    merge = [{"b_id": existing[k], "b_count": c, "b_xp": xp, "b_n": n} for k, (c, xp, n) in sums.items() if k in existing]
+    new = [{"day": d, "user_id": u, "task_id": t, "manager_id": m, "count": c, "xp": xp, "submissions": n}
+           for (d, u, t, m), (c, xp, n) in sums.items() if (d, u, t, m) not in existing]
+    if merge:
+        r_t = SubmissionRollup.__table__
+        await db.execute(
+            update(r_t).where(r_t.c.id == bindparam("b_id")).values(
+                count=r_t.c.count + bindparam("b_count"), xp=r_t.c.xp + bindparam("b_xp"),
+                submissions=r_t.c.submissions + bindparam("b_n")),
+            merge,
+        )
+    if new:
+        await db.execute(insert(SubmissionRollup), new)
+    ids = [r[0] for r in rows]
+    if archive:
+        cols = [Submission.id, Submission.user_id, Submission.task_id, Submission.manager_id,
+                Submission.count, Submission.xp_awarded, Submission.created_at]
+        await db.execute(insert(SubmissionArchive).from_select([c.key for c in cols],
+                                                               select(*cols).where(Submission.id.in_(ids))))
+    await db.execute(delete(Submission).where(Submission.id.in_(ids)))
+    await db.commit()  # свёртка и удаление — одной транзакцией, суммы XP всё время сходятся
+    rep.raw_rows += len(rows)
+    rep.rollups_added += len(new)
+    rep.rollups_merged += len(merge)
+    return len(rows)
+
+
+async def compact_submissions(db: AsyncSession, after_days: int | None = None, batch: int | None = None,
+                              archive: bool | None = None) -> CompactReport:
+    """Свернуть submissions старше after_days дней (по целым локальным дням) пачками по batch строк.
+    after_days <= 0 — свёртка выключена, ничего не делает."""
+    after_days = settings.rollup_after_days if after_days is None else after_days
+    batch = batch or settings.rollup_batch
+    archive = settings.rollup_archive if archive is None else archive
+    rep = CompactReport(cutoff=cutoff_day(after_days))
+    if after_days <= 0:
+        return rep
+    before = day_start_utc(rep.cutoff)
+    while await _compact_batch(db, before, batch, archive, rep) == batch:
+        pass
+    return rep
@@ -0,0 +1,118 @@
+from __future__ import annotations
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .models import Task
+
+
+@dataclass(frozen=True)
+class TaskRow:
+    id: int
+    code: str
+    name: str
+    xp: int
+    active: bool = True  # False — в архиве: есть в by_id (история, выгрузки), но не в списке и поиске
+
+
+@dataclass(frozen=True)
+class Match:
+    task: TaskRow
+    score: float  # 0..1, 1 — код или точное вхождение запроса в название
+
+
+_word = re.compile(r"\w+")
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё -> е, только буквы/цифры через пробел."""
+    return " ".join(_word.findall(text.lower().replace("ё", "е")))
+
+def trigrams(text: str) -> set[str]:
+    """Триграммы по словам с отступами, как в pg_trgm: «отзыв» -> «  о», « от», «отз», …, «ыв »."""
+    grams: set[str] = set()
+    for w in text.split():
+        w = f"  {w} "
+        grams.update(w[i:i + 3] for i in range(len(w) - 2))
+    return grams
+
+
+@dataclass(frozen=True)
+class TaskIndex:
+    """Неизменяемый поисковый индекс заданий: код -> задание и триграммы нормализованных названий.
+    tasks, by_code и поиск — только активные задания; by_id — все, включая архивные."""
+    tasks: tuple[TaskRow, ...] = ()
+    by_code: dict[str, TaskRow] = field(default_factory=dict)
+    by_id: dict[int, TaskRow] = field(default_factory=dict)
+    names: tuple[str, ...] = ()
+    sizes: tuple[int, ...] = ()  # число триграмм в названии
+    postings: dict[str, tuple[int, ...]] = field(default_factory=dict)  # триграмма -> позиции в tasks
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[TaskRow]) -> TaskIndex:
+        rows = list(rows)
+        tasks = tuple(sorted((t for t in rows if t.active), key=lambda t: t.code))
+        names = tuple(normalize(t.name) for t in tasks)
+        postings: dict[str, list[int]] = {}
+        for i, name in enumerate(names):
+            for g in trigrams(name):
+                postings.setdefault(g, []).append(i)
+        return cls(
+            tasks=tasks,
+            by_code={t.code.lower(): t for t in tasks},
+            by_id={t.id: t for t in rows},
+            names=names,
+            sizes=tuple(len(trigrams(n)) for n in names),
+            postings={g: tuple(ix) for g, ix in postings.items()},
+        )
+
+    def search(self, query: str, limit: int = 5, min_score: float = 0.3) -> list[Match]:
+        """Кандидаты по убыванию похожести. Терпит опечатки и другой порядок слов."""
+        q = query.strip().lower()
+        if q in self.by_code:
+            return [Match(self.by_code[q], 1.0)]
+        nq = normalize(q)
+        qgrams = trigrams(nq)
+        if not qgrams:
+            return []
+        hits: Counter[int] = Counter()
+        for g in qgrams:
+            for i in self.postings.get(g, ()):
+                hits[i] += 1
+        out: list[Match] = []
+        for i, common in hits.items():
+            if nq in self.names[i]:
+                score = 1.0
+            else:
+                # доля триграмм запроса, найденных в названии, с небольшим штрафом за длинные названия
+                score = 0.8 * common / len(qgrams) + 0.2 * 2 * common / (len(qgrams) + self.sizes[i])
+            if score >= min_score:
+                out.append(Match(self.tasks[i], score))
+        out.sort(key=lambda m: (-m.score, m.task.code))
+        return out[:limit]
+
+    def best(self, query: str, margin: float = 0.15, min_score: float = 0.5) -> TaskRow | None:
+        """Однозначный лучший кандидат или None (не найдено или несколько похожих)."""
+        found = self.search(query, limit=2)
+        if not found or found[0].score < min_score:
+            return None
+        if len(found) > 1 and found[0].score - found[1].score < margin:
+            return None
+        return found[0].task
+
+
+_index = TaskIndex()
+
+def task_index() -> TaskIndex:
+    return _index
+
+def set_tasks(rows: Iterable[TaskRow]) -> TaskIndex:
+    global _index
+    _index = TaskIndex.from_rows(rows)
+    return _index
+
+def load_tasks(db: Session) -> TaskIndex:
+    """Перечитать задания из БД (на старте и после импорта)."""
+    return set_tasks(TaskRow(id=t.id, code=t.code, name=t.name, xp=t.xp, active=t.active)
+                     for t in db.scalars(select(Task)))
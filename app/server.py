@@ -1,47 +1,227 @@
 from __future__ import annotations
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from aiogram import Dispatcher as AioDispatcher
-from aiogram.types import Update
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-import sys, traceback
-
-from .config import settings
-from .db import engine, Base, SessionLocal
-from .importer import import_tasks_levels
-from .bot import bot, router
+from .startup import report as startup_report  # первым: от него считается время старта
+import asyncio, importlib, json, sys, time, traceback, uuid, zlib
+from typing import Literal
+
+# Холодный старт: при импорте модуля грузится только то, что нужно для приёма HTTP (FastAPI, SQLAlchemy).
+# aiogram (самый тяжёлый импорт), Bot, планировщик и справочники поднимаются в фоне после старта —
+# сервер уже отвечает, а апдейты, пришедшие раньше, ждут в буфере (см. warmup).
+
+with startup_report.importing("fastapi"):
+    from fastapi import Depends, FastAPI, Header, Request, HTTPException, Query
+    from fastapi.responses import JSONResponse, PlainTextResponse, Response
+with startup_report.importing("app.db"):
+    from sqlalchemy import select
+    from .config import settings, safe_tz
+    from .db import SessionLocal, AsyncSessionLocal, async_engine
+with startup_report.importing("app.logic"):
+    from .logic import (rebuild_period_xp, period_xp_missing, reconcile_xp, load_rankings, leaderboard, get_profile,
+                        current_ranking, period_bucket, data_version, PERIODS)
+    from .models import User
+    from .users import UserSnapshot, user_cache
+    from .levels import load_levels, level_index
+    from .search import load_tasks
+with startup_report.importing("app.export"):
+    from .export import router as export_router, check_token
+with startup_report.importing("app.importer"):
+    from .importer import import_tasks_levels
+with startup_report.importing("app.services"):
+    from .migrate import migrate
+    from .dedup import UpdateDedup
+    from .leader import LeaseHolder
+    from .rollups import compact_submissions
+    from . import metrics
 
 app = FastAPI(title="PLG RPG Bot")
-Base.metadata.create_all(bind=engine)
+dedup = UpdateDedup(window=settings.dedup_window, ttl=settings.dedup_ttl)
+metrics.instrument_engine(async_engine.sync_engine)
+startup_report.mark("imported")
 
-def _safe_tz(name: str) -> ZoneInfo:
-    """Фолбэк на UTC, если TZ задана неверно (чтобы сервис не падал)."""
+@app.middleware("http")
+async def http_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
     try:
-        return ZoneInfo(name)
-    except ZoneInfoNotFoundError:
-        return ZoneInfo("UTC")
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # шаблон пути (/webhook/{secret}), а не сам путь — чтобы не плодить метки и не светить секрет
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.http_seconds.observe(time.perf_counter() - start, route, request.method, str(status))
+
+def leader_only(job):
+    """Обёртка для задач планировщика: выполнять только в воркере-лидере."""
+    async def run():
+        # продлеваем перед запуском: не запускаем задачу на истёкшей аренде
+        if app.state.leader.held and await app.state.leader.acquire():
+            await job()
+    run.__name__ = job.__name__
+    return run
+
+async def import_module(name: str):
+    """Импорт в потоке: event loop тем временем отвечает на запросы."""
+    with startup_report.importing(name):
+        return await asyncio.to_thread(importlib.import_module, name)
 
 @app.on_event("startup")
 async def on_startup():
-    # импорт Excel при запуске
+    app.state.ready = asyncio.Event()
+    app.state.pending = []  # апдейты, принятые до запуска воркеров
+    app.state.startup_error = None  # warmup упал: вебхук отвечает 503, /healthz — не ok
+    app.state.bot = app.state.updates = app.state.outbox = app.state.leader = app.state.scheduler = None
+    # схема — до приёма запросов (processed_updates нужна вебхуку); без изменений моделей — один SELECT
+    with startup_report.phase("migrate"):
+        if await asyncio.to_thread(migrate):
+            print("Schema migrated", file=sys.stderr)
+    app.state.warmup = asyncio.create_task(warmup(), name="warmup")
+    startup_report.mark("serving")
+
+def _import_excel():
     with SessionLocal() as db:
-        import_tasks_levels(db)
-    # aiogram
+        return import_tasks_levels(db)
+
+def _load_from_db():
+    with SessionLocal() as db:
+        load_levels(db); load_tasks(db)
+
+async def load_reference_data():
+    # импорт Excel при запуске (пропускается, если файлы не менялись).
+    # Воркеры импортируют по очереди под арендой "import": без гонок по tasks/levels,
+    # а индексы в памяти каждого воркера всё равно загружаются из БД.
+    import_lease = LeaseHolder("import", ttl=settings.import_lease_timeout)
+    if await import_lease.wait(timeout=settings.import_lease_timeout):
+        try:
+            report = await asyncio.to_thread(_import_excel)
+            print("Import:", report, file=sys.stderr)
+            # агрегаты топа пусты после перехода со старой схемы — считаем один раз
+            async with AsyncSessionLocal() as db:
+                if await period_xp_missing(db):
+                    await rebuild_period_xp(db)
+        finally:
+            await import_lease.release()
+    else:
+        print("Import: lease busy, loading tasks/levels from DB", file=sys.stderr)
+        await asyncio.to_thread(_load_from_db)
+    async with AsyncSessionLocal() as db:
+        await load_rankings(db)
+
+async def warmup():
+    """Всё, что нужно для обработки апдейтов: справочники и рейтинги, aiogram, воркеры, планировщик.
+    aiogram импортируется в потоке параллельно с загрузкой данных из БД."""
+    try:
+        bot_import = asyncio.create_task(import_module("app.bot"))
+        with startup_report.phase("reference_data"):
+            await load_reference_data()
+        bot_module = await bot_import
+        await import_module("apscheduler.schedulers.asyncio")
+        with startup_report.phase("workers"):
+            start_workers(bot_module)
+            start_scheduler()
+        await drain_pending()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print("Startup failed:", e, file=sys.stderr)
+        traceback.print_exc()
+        app.state.startup_error = repr(e)
+        startup_report.log(ok=False)
+        await release_pending()
+        return
+    startup_report.mark("ready")
+    startup_report.log(ok=True)
+
+def start_workers(bot_module):
+    from aiogram import Dispatcher as AioDispatcher
+    from .updates import UpdateQueue
+    app.state.bot = bot_module.make_bot()
     app.state.dp = AioDispatcher()
-    app.state.dp.include_router(router)
-    # планировщик (каждый день 10:00 локального времени)
-    app.state.scheduler = AsyncIOScheduler(timezone=_safe_tz(settings.timezone))
-    app.state.scheduler.add_job(broadcast_heroes, CronTrigger(hour=10, minute=0))
+    app.state.dp.include_router(bot_module.router)
+    # апдейты вебхука разбирает пул воркеров, вебхук только кладёт их в очередь
+    app.state.updates = UpdateQueue(
+        app.state.dp, app.state.bot,
+        workers=settings.update_workers,
+        maxsize=settings.update_queue_size,
+        put_timeout=settings.update_put_timeout,
+    )
+    app.state.updates.start()
+    user_cache.start(settings.user_flush_interval)
+    app.state.outbox = bot_module.outbox
+    app.state.outbox.bot = app.state.bot
+    app.state.outbox.start()
+
+def start_scheduler():
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+    from .broadcast import broadcast_heroes, retry_failed as retry_broadcasts
+    # планировщик есть в каждом воркере, но задачи выполняет только держатель аренды "scheduler"
+    app.state.leader = LeaseHolder("scheduler", ttl=settings.leader_lease_ttl)
+    app.state.leader.start()
+    app.state.scheduler = AsyncIOScheduler(timezone=safe_tz(settings.timezone))
+    # рассылка героев каждый день 10:00 локального времени
+    app.state.scheduler.add_job(leader_only(broadcast_heroes), CronTrigger(hour=10, minute=0))
+    # недоставленные рассылки — повтор каждые 10 минут
+    app.state.scheduler.add_job(leader_only(retry_broadcasts), IntervalTrigger(minutes=10))
+    # свёртка старых выполнений в дневные итоги — до ночной сверки
+    if settings.rollup_after_days > 0:
+        app.state.scheduler.add_job(leader_only(compact_job), CronTrigger(hour=3, minute=30))
+    # отметки обработанных апдейтов старше DEDUP_TTL
+    app.state.scheduler.add_job(leader_only(dedup.prune), IntervalTrigger(hours=1))
+    # ночная сверка xp_total с submissions
+    app.state.scheduler.add_job(leader_only(reconcile_job), CronTrigger(hour=4, minute=0))
+    # рейтинги в памяти — в каждом воркере: подтягиваем начисления, сделанные другими воркерами
+    app.state.scheduler.add_job(refresh_rankings, IntervalTrigger(seconds=settings.ranking_refresh_interval))
     app.state.scheduler.start()
 
+async def drain_pending():
+    """Переложить апдейты из буфера старта в очередь воркеров (по порядку) и открыть прямой приём.
+    ready ставится только на пустом буфере — новые апдейты не обгонят ждущие."""
+    from aiogram.types import Update
+    pending = app.state.pending
+    while pending:
+        data = pending.pop(0)
+        try:
+            update = Update.model_validate(data)
+        except Exception as e:
+            metrics.webhook_errors.inc()
+            print("Webhook error:", e, file=sys.stderr)
+            continue
+        metrics.log_update(update)
+        while not await app.state.updates.put(update):  # уже подтверждён Telegram — не теряем
+            pass
+    app.state.ready.set()
+
+async def release_pending():
+    """Бот не поднялся: апдейты из буфера никто не обработает. Пишем, сколько потеряно, и снимаем
+    отметки дедупликации — если Telegram доставит их повторно, после рестарта они не уйдут в дубли."""
+    pending, app.state.pending = app.state.pending, []
+    for data in pending:
+        try:
+            await dedup.forget(int(data["update_id"]))
+        except Exception as e:
+            print("Dedup forget failed:", data.get("update_id"), e, file=sys.stderr)
+    if pending:
+        print("Startup failed, buffered updates dropped:", len(pending), file=sys.stderr)
+
 @app.on_event("shutdown")
 async def on_shutdown():
+    app.state.warmup.cancel()
+    await asyncio.gather(app.state.warmup, return_exceptions=True)
+    if app.state.pending:
+        print("Shutdown: updates not processed:", len(app.state.pending), file=sys.stderr)
+    if app.state.updates:
+        await app.state.updates.stop()
+    await user_cache.stop()
+    if app.state.outbox:
+        await app.state.outbox.stop()
     try:
         app.state.scheduler.shutdown(wait=False)
     except Exception:
         pass
+    if app.state.leader:
+        await app.state.leader.stop()
+    await async_engine.dispose()
 
 @app.get("/")
 async def root():
@@ -51,9 +231,44 @@ async def root():
 async def ping():
     return {"pong": True}
 
+def _outbox_stats() -> dict:
+    if app.state.outbox:
+        return app.state.outbox.stats()
+    return {"queued": 0, "sent": 0, "retried": 0, "dropped": 0}
+
+def _queue_stats() -> dict:
+    if app.state.updates:
+        return app.state.updates.stats()
+    return {"depth": len(app.state.pending), "rejected": 0, "failed": 0}
+
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True}
+    error = app.state.startup_error
+    body = {"ok": error is None, "ready": app.state.ready.is_set(), "pending": len(app.state.pending),
+            "queue": _queue_stats(), "users": user_cache.stats(), "outbox": _outbox_stats(),
+            "dedup": dedup.stats(), "leader": bool(app.state.leader and app.state.leader.held),
+            "startup": {**startup_report.as_dict(), "error": error}}
+    # 503 — чтобы проверка здоровья хостинга перезапустила инстанс с упавшим стартом
+    return JSONResponse(body, status_code=503 if error else 200)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    q, users, out = _queue_stats(), user_cache.stats(), _outbox_stats()
+    gauges = {
+        "update_queue_depth": q["depth"],
+        "update_queue_rejected_total": q["rejected"],
+        "update_failed_total": q["failed"],
+        "user_cache_hits_total": users["hits"],
+        "user_cache_misses_total": users["misses"],
+        "outbox_queued": out["queued"],
+        "outbox_sent_total": out["sent"],
+        "outbox_retried_total": out["retried"],
+        "outbox_dropped_total": out["dropped"],
+    }
+    for mark in ("ready", "first_update"):
+        if mark in startup_report.marks:
+            gauges[f"startup_{mark}_seconds"] = startup_report.marks[mark]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 @app.get("/setup-webhook")
 async def setup_webhook(secret: str):
@@ -61,49 +276,157 @@ async def setup_webhook(secret: str):
         raise HTTPException(status_code=403, detail="forbidden")
     if not settings.webhook_base:
         raise HTTPException(status_code=400, detail="WEBHOOK_BASE not set")
+    if not app.state.bot:
+        raise HTTPException(status_code=503, detail="starting")
     url = f"{settings.webhook_base.rstrip('/')}/webhook/{settings.webhook_secret}"
-    await bot.set_webhook(url)
+    await app.state.bot.set_webhook(url)
     return {"webhook": url}
 
+# выгрузки для HR: /export/submissions, /export/leaderboard (EXPORT_TOKEN)
+app.include_router(export_router)
+
+# --- JSON API для дашбордов -----------------------------------------------------------
+# Ответы кэшируются в процессе по версии данных (растёт при начислениях и импорте).
+# ETag = процесс + версия + ключ: повторный опрос с If-None-Match получает 304 без обращения к БД.
+
+API_MAX_AGE = 5
+_BOOT = uuid.uuid4().hex[:8]  # после рестарта версии начинаются заново — ETag не должен совпасть
+_api_cache: dict[tuple, tuple[str, bytes]] = {}
+
+def _etag(key: tuple) -> str:
+    return f'W/"{_BOOT}.{data_version()}.{zlib.crc32(repr(key).encode()):08x}"'
+
+async def _cached_json(request: Request, key: tuple, build, cache: str = "public") -> Response:
+    etag = _etag(key)  # до build(): если данные поменяются во время запроса, следующий опрос их заберёт
+    headers = {"ETag": etag, "Cache-Control": f"{cache}, max-age={API_MAX_AGE}"}
+    if etag in {t.strip() for t in request.headers.get("if-none-match", "").split(",")}:
+        return Response(status_code=304, headers=headers)
+    hit = _api_cache.get(key)
+    if hit and hit[0] == etag:
+        body = hit[1]
+    else:
+        body = json.dumps(await build(), ensure_ascii=False).encode()
+        if len(_api_cache) > 10000:
+            _api_cache.clear()
+        _api_cache[key] = (etag, body)
+    return Response(body, media_type="application/json", headers=headers)
+
+def _level_json(level) -> dict | None:
+    return {"num": level.num, "title": level.title, "xp_required": level.xp_required} if level else None
+
+@app.get("/api/leaderboard")
+async def api_leaderboard(request: Request, period: Literal["week", "month", "all"] = "week",
+                          limit: int = Query(10, ge=1, le=100)):
+    bucket = None if period == "all" else period_bucket(period)
+
+    async def build():
+        async with AsyncSessionLocal() as db:
+            rows = await leaderboard(db, period, limit=limit)
+        items, rank, prev = [], 0, None
+        for i, (u, xp) in enumerate(rows, start=1):
+            if xp != prev:
+                rank, prev = i, xp
+            level = level_index().current(u.xp_total)
+            # публичный ответ: только отображаемое имя, без tg_id и username
+            items.append({"rank": rank, "name": u.full_name, "xp": xp, "level": level.num if level else None})
+        return {"period": period, "bucket": bucket.isoformat() if bucket else None, "items": items}
+
+    return await _cached_json(request, ("leaderboard", period, bucket, limit), build)
+
+def require_api_token(token: str | None = None, authorization: str | None = Header(default=None)) -> None:
+    """API_TOKEN для профилей: в них tg_id и username, и их можно перебирать по tg_id."""
+    check_token(settings.api_token, token, authorization, "api")
+
+@app.get("/api/users/{tg_id}/profile", dependencies=[Depends(require_api_token)])
+async def api_profile(request: Request, tg_id: int):
+    buckets = tuple(period_bucket(p) for p in PERIODS)
+
+    async def build():
+        u = user_cache.get(tg_id)
+        if u is None:
+            async with AsyncSessionLocal() as db:
+                row = await db.scalar(select(User).where(User.tg_id == tg_id))
+            if row is None:
+                raise HTTPException(status_code=404, detail="user not found")
+            u = user_cache.put(UserSnapshot.of(row))
+        prof = get_profile(u)
+        ranks = {}
+        for period in ("all", *PERIODS):
+            r = current_ranking(period)
+            ranks[period] = {"rank": r.rank(u.id), "of": len(r), "xp": r.scores.get(u.id, 0),
+                             "gap_to_next": r.gap_to_next(u.id)}
+        return {
+            "tg_id": u.tg_id, "username": u.username, "full_name": u.full_name, "xp": u.xp_total,
+            "level": _level_json(prof.level), "next_level": _level_json(prof.next_level),
+            "progress_to_next": prof.progress_to_next, "ranks": ranks,
+        }
+
+    return await _cached_json(request, ("profile", tg_id, buckets), build, cache="private")
+
+def _bad_update(e: Exception) -> JSONResponse:
+    metrics.webhook_errors.inc()
+    # ключевой лог — покажет точную причину 500
+    print("Webhook error:", e, file=sys.stderr)
+    traceback.print_exc()
+    # отвечаем 200, чтобы Telegram не долбил повторами
+    return JSONResponse({"ok": False}, status_code=200)
+
+def _not_accepted() -> JSONResponse:
+    """503 — Telegram повторит доставку позже (очередь полна или бот не поднялся)."""
+    reason = "startup failed" if app.state.startup_error else "full"
+    return JSONResponse({"ok": False, "queue": reason}, status_code=503, headers={"Retry-After": "5"})
+
 # >>> Диагностически безопасный обработчик вебхука
 @app.post("/webhook/{secret}")
 async def telegram_webhook(secret: str, request: Request):
     if secret != settings.webhook_secret:
         raise HTTPException(status_code=403, detail="forbidden")
+    if app.state.startup_error:
+        return _not_accepted()
     try:
         data = await request.json()
-        # логируем сырой апдейт для диагностики
-        print("Webhook update:", data, file=sys.stderr)
-        update = Update.model_validate(data)
-        await app.state.dp.feed_update(bot, update)
-        return JSONResponse({"ok": True})
+        update_id = int(data["update_id"])
     except Exception as e:
-        # ключевой лог — покажет точную причину 500
-        print("Webhook error:", e, file=sys.stderr)
-        traceback.print_exc()
-        # отвечаем 200, чтобы Telegram не долбил повторами
-        return JSONResponse({"ok": False}, status_code=200)
+        return _bad_update(e)
+    # повтор доставки (Telegram не дождался ответа) — подтверждаем, но не обрабатываем снова
+    if await dedup.seen(update_id):
+        metrics.webhook_duplicates.inc()
+        return JSONResponse({"ok": True, "duplicate": True})
+    if not app.state.ready.is_set():
+        # бот ещё загружается: апдейт ждёт в буфере и уйдёт воркерам первым, как только они запустятся
+        accepted = not app.state.startup_error and len(app.state.pending) < settings.update_queue_size
+        if accepted:
+            app.state.pending.append(data)
+    else:
+        try:
+            from aiogram.types import Update  # загружен в warmup — здесь только поиск в sys.modules
+            update = Update.model_validate(data)
+            metrics.log_update(update)
+        except Exception as e:
+            return _bad_update(e)
+        # обработка идёт в воркерах; если очередь забита — 503, Telegram повторит позже
+        accepted = await app.state.updates.put(update)
+    if not accepted:
+        await dedup.forget(update_id)
+        return _not_accepted()
+    startup_report.mark("first_webhook")
+    return JSONResponse({"ok": True})
 
-async def broadcast_heroes():
-    if not settings.broadcast_chat_id:
-        return
-    from .logic import leaderboard
-    with SessionLocal() as db:
-        week = leaderboard(db, "week")
-        month = leaderboard(db, "month")
-
-    def fmt(rows, title):
-        if not rows:
-            return f"<b>{title}</b>\nНет данных."
-        lines = [f"<b>{title}</b>"]
-        for i, (u, xp) in enumerate(rows[:5], start=1):
-            name = u.full_name or ("@" + u.username if u.username else str(u.tg_id))
-            lines.append(f"{i}. {name} — {xp} XP")
-        return "\n".join(lines)
-
-    text = fmt(week, "Герои недели") + "\n\n" + fmt(month, "Герои месяца")
-    try:
-        await bot.send_message(settings.broadcast_chat_id, text)
-    except Exception:
-        pass
+async def reconcile_job():
+    async with AsyncSessionLocal() as db:
+        drift = await reconcile_xp(db, fix=True)
+    if drift:
+        print("XP drift fixed:", [(d.tg_id, d.stored, d.actual) for d in drift[:50]], file=sys.stderr)
+
+async def compact_job():
+    async with AsyncSessionLocal() as db:
+        report = await compact_submissions(db)
+    if report.raw_rows:
+        print("Rollup:", report, file=sys.stderr)
 
+async def refresh_rankings():
+    try:
+        async with AsyncSessionLocal() as db:
+            await load_rankings(db)
+    except Exception as e:
+        print("Ranking refresh error:", e, file=sys.stderr)
@@ -0,0 +1,67 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from datetime import date
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import User
+from .logic import current_ranking, period_bucket, data_version
+
+# Снимки топа с готовым текстом. Места и XP — из рейтинга в памяти (ranking.Ranking.top), из БД — только
+# имена топа одним запросом, пока данные не менялись (data_version) и не началась новая неделя/месяц;
+# /top и рассылка героев берут текст отсюда.
+
+TOP_LIMIT = 10
+HEROES_LIMIT = 5
+TITLES = {"week": "Герои недели", "month": "Герои месяца"}
+
+
+@dataclass(frozen=True)
+class Standing:
+    period: str
+    bucket: date | None  # для all — None
+    version: int
+    rows: tuple[tuple[str, int], ...]  # (имя, XP) по убыванию
+    text: str  # как показывает /top
+
+
+def display_name(u) -> str:
+    return u.full_name or ("@" + u.username if u.username else str(u.tg_id))
+
+def render_top(period: str, rows: tuple[tuple[str, int], ...]) -> str:
+    if not rows:
+        return "Пока нет данных по топу."
+    lines = [f"<b>Топ ({period})</b>"]
+    lines += [f"{i}. {name} — {xp} XP" for i, (name, xp) in enumerate(rows, start=1)]
+    return "\n".join(lines)
+
+def render_heroes(*standings: Standing) -> str:
+    parts = []
+    for s in standings:
+        rows = s.rows[:HEROES_LIMIT]
+        title = TITLES.get(s.period, s.period)
+        if not rows:
+            parts.append(f"<b>{title}</b>\nНет данных.")
+            continue
+        lines = [f"<b>{title}</b>"]
+        lines += [f"{i}. {name} — {xp} XP" for i, (name, xp) in enumerate(rows, start=1)]
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+
+_cache: dict[str, Standing] = {}
+
+async def standing(db: AsyncSession, period: str) -> Standing:
+    """Снимок топа периода из кэша или заново по рейтингу в памяти (если данные изменились)."""
+    version = data_version()  # до запроса: начисление во время запроса сделает снимок устаревшим
+    bucket = None if period == "all" else period_bucket(period)
+    s = _cache.get(period)
+    if s and s.version == version and s.bucket == bucket:
+        return s
+    places = current_ranking(period).top(TOP_LIMIT)
+    users = {}
+    if places:
+        users = {u.id: u for u in await db.scalars(select(User).where(User.id.in_([p.user_id for p in places])))}
+    rows = tuple((display_name(users[p.user_id]), p.xp) for p in places if p.user_id in users)
+    s = Standing(period=period, bucket=bucket, version=version, rows=rows, text=render_top(period, rows))
+    _cache[period] = s
+    return s
@@ -0,0 +1,49 @@
+from __future__ import annotations
+import json, sys, time
+from contextlib import contextmanager
+
+# Отчёт о холодном старте: сколько заняли импорты, фазы запуска и путь до первого обработанного
+# апдейта. Без зависимостей — app.server импортирует его первым, от этого момента и считается время.
+
+
+class StartupReport:
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.imports: dict[str, float] = {}  # модуль -> сек (прирост: уже загруженное не считается)
+        self.phases: dict[str, float] = {}  # фаза запуска -> сек
+        self.marks: dict[str, float] = {}  # событие -> сек от старта процесса (первое наступление)
+
+    def elapsed(self) -> float:
+        return round(time.perf_counter() - self.t0, 3)
+
+    @contextmanager
+    def importing(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.imports[name] = round(time.perf_counter() - start, 3)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+
+    def mark(self, name: str) -> bool:
+        """Отметить событие (только первое). True — отмечено сейчас."""
+        if name in self.marks:
+            return False
+        self.marks[name] = self.elapsed()
+        return True
+
+    def as_dict(self) -> dict:
+        return {"imports": self.imports, "phases": self.phases, "marks": self.marks}
+
+    def log(self, **extra) -> None:
+        print(json.dumps({"event": "startup", **self.as_dict(), **extra}, ensure_ascii=False), file=sys.stderr)
+
+
+report = StartupReport()
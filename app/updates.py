@@ -0,0 +1,114 @@
+from __future__ import annotations
+import asyncio, sys, time, traceback
+from typing import Any, Awaitable, Callable
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import TelegramObject, Update
+from . import metrics
+from .startup import report as startup_report
+
+
+def update_key(update: Update) -> int:
+    """Ключ шардирования: id отправителя (или чата), чтобы апдейты одного юзера шли по порядку."""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user:
+        return user.id
+    chat = getattr(event, "chat", None)
+    return chat.id if chat else update.update_id
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Латентность, ошибки и запросы к БД по каждому хендлеру (ставится на router.message)."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        start = time.perf_counter()
+        with metrics.track_db() as stats:
+            try:
+                return await handler(event, data)
+            except Exception:
+                metrics.command_errors.inc(name)
+                raise
+            finally:
+                metrics.command_seconds.observe(time.perf_counter() - start, name)
+                metrics.update_db_queries.observe(stats[0], name)
+                metrics.update_db_seconds.observe(stats[1], name)
+
+
+class UpdateQueue:
+    """Ограниченная очередь апдейтов + пул воркеров.
+
+    Каждый воркер читает свою очередь, апдейт попадает в очередь по ключу отправителя —
+    так апдейты одного пользователя обрабатываются строго последовательно,
+    а разные пользователи — параллельно.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = 4, maxsize: int = 1000, put_timeout: float = 5.0):
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.put_timeout = put_timeout
+        per_worker = max(1, -(-maxsize // self.workers))  # ceil
+        self.queues: list[asyncio.Queue[Update]] = [asyncio.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self.tasks: list[asyncio.Task] = []
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._worker(q), name=f"update-worker-{i}") for i, q in enumerate(self.queues)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дождаться разбора очереди (не дольше timeout) и остановить воркеров."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def put(self, update: Update) -> bool:
+        """Поставить апдейт в очередь. False — очередь переполнена дольше put_timeout (backpressure)."""
+        q = self.queues[update_key(update) % self.workers]
+        try:
+            await asyncio.wait_for(q.put(update), self.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "capacity": sum(q.maxsize for q in self.queues),
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    async def _worker(self, q: asyncio.Queue[Update]) -> None:
+        while True:
+            update = await q.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+                if startup_report.mark("first_update"):
+                    print(f"Startup: first update handled at {startup_report.marks['first_update']}s", file=sys.stderr)
+            except Exception as e:
+                self.failed += 1
+                print("Update error:", update.update_id, e, file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                q.task_done()
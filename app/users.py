@@ -0,0 +1,116 @@
+from __future__ import annotations
+import asyncio, sys, time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from sqlalchemy import update, bindparam
+from .config import settings
+from .db import AsyncSessionLocal
+from .models import User
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """То, что нужно хендлерам о пользователе, без ORM-сессии."""
+    id: int
+    tg_id: int
+    username: str | None
+    full_name: str | None
+    is_manager: bool
+    xp_total: int
+
+    @classmethod
+    def of(cls, u: User) -> UserSnapshot:
+        return cls(id=u.id, tg_id=u.tg_id, username=u.username, full_name=u.full_name,
+                   is_manager=bool(u.is_manager), xp_total=u.xp_total or 0)
+
+
+class UserCache:
+    """LRU + TTL кэш tg_id -> UserSnapshot.
+
+    Смена username/full_name не пишется в БД сразу: изменения копятся в pending
+    и сбрасываются пачкой фоновой задачей (write-behind).
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[int, tuple[float, UserSnapshot]] = OrderedDict()
+        self._pending: dict[int, tuple[str | None, str | None]] = {}
+        self._task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+
+    def get(self, tg_id: int) -> UserSnapshot | None:
+        item = self._data.get(tg_id)
+        if item and item[0] > time.monotonic():
+            self._data.move_to_end(tg_id)
+            self.hits += 1
+            return item[1]
+        if item:
+            del self._data[tg_id]
+        self.misses += 1
+        return None
+
+    def put(self, snap: UserSnapshot) -> UserSnapshot:
+        self._data[snap.tg_id] = (time.monotonic() + self.ttl, snap)
+        self._data.move_to_end(snap.tg_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return snap
+
+    def invalidate(self, tg_id: int) -> None:
+        self._data.pop(tg_id, None)
+
+    def set_xp(self, tg_id: int, xp_total: int) -> None:
+        """Обновить XP в кэше после начисления (если пользователь там есть)."""
+        item = self._data.get(tg_id)
+        if item:
+            self._data[tg_id] = (item[0], replace(item[1], xp_total=xp_total))
+
+    def rename(self, snap: UserSnapshot, username: str | None, full_name: str | None) -> UserSnapshot:
+        """Новые имена — сразу в кэш, в БД — при следующем flush()."""
+        snap = replace(snap, username=username or snap.username, full_name=full_name or snap.full_name)
+        self._pending[snap.tg_id] = (snap.username, snap.full_name)
+        return self.put(snap)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "pending": len(self._pending), "flushed": self.flushed}
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        stmt = (update(User.__table__).where(User.__table__.c.tg_id == bindparam("b_tg_id"))
+                .values(username=bindparam("b_username"), full_name=bindparam("b_full_name")))
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(stmt, [
+                    {"b_tg_id": tg_id, "b_username": un, "b_full_name": fn} for tg_id, (un, fn) in batch.items()
+                ])
+                await db.commit()
+        except Exception as e:
+            # не теряем изменения: вернём в очередь (новые имена важнее старых)
+            self._pending = {**batch, **self._pending}
+            print("User flush error:", e, file=sys.stderr)
+            return 0
+        self.flushed += len(batch)
+        return len(batch)
+
+    def start(self, interval: float) -> None:
+        async def loop():
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush()
+        self._task = asyncio.create_task(loop(), name="user-cache-flush")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+user_cache = UserCache(maxsize=settings.user_cache_size, ttl=settings.user_cache_ttl)
@@ -0,0 +1,101 @@
+"""Сравнение профилей движка БД под конкурентной нагрузкой: писатели делают award(),
+читатели — топ недели. Без --url каждый профиль гоняется на своём временном SQLite-файле.
+
+    python -m bench.db_profiles --seconds 5 --writers 4 --readers 8
+    python -m bench.db_profiles --url postgresql://user:pw@localhost/plg_bench
+
+Для --url нужна пустая отдельная база: таблицы создаются, при непустой users бенчмарк откажется работать.
+"""
+from __future__ import annotations
+import argparse, asyncio, os, random, tempfile, time
+from dataclasses import dataclass
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.db import Base, EngineProfile, make_async_engine
+from app.models import User, Task
+from app.logic import award, leaderboard
+from app.search import TaskRow
+from app.users import UserSnapshot
+
+# «как было»: настройки по умолчанию SQLAlchemy/SQLite, без WAL и pre-ping
+PROFILES = {
+    "default": EngineProfile(pool_recycle=-1, pool_pre_ping=False, sqlite_journal_mode="",
+                             sqlite_synchronous="", sqlite_busy_timeout_ms=5000),
+    "tuned": EngineProfile.from_settings(),
+}
+
+@dataclass
+class Result:
+    profile: str
+    writes: int = 0
+    reads: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+
+    def row(self) -> str:
+        return (f"{self.profile:<10} {self.writes / self.seconds:>10.1f} {self.reads / self.seconds:>10.1f} "
+                f"{self.errors:>7}")
+
+async def run(url: str, name: str, profile: EngineProfile, seconds: float, writers: int, readers: int, users: int) -> Result:
+    eng = make_async_engine(url, profile)
+    Session = async_sessionmaker(eng, expire_on_commit=False)
+    async with eng.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with Session() as db:
+        if await db.scalar(select(func.count()).select_from(User)):
+            raise SystemExit("users не пуста — запускайте на отдельной пустой базе")
+        db.add_all([User(tg_id=10_000 + i, username=f"bench{i}", full_name=f"Bench {i}", xp_total=0) for i in range(users)])
+        db.add(Task(code="B001", name="bench", xp=10))
+        await db.commit()
+        snaps = [UserSnapshot.of(u) for u in await db.scalars(select(User))]
+        t = await db.scalar(select(Task).where(Task.code == "B001"))
+        task = TaskRow(id=t.id, code=t.code, name=t.name, xp=t.xp)
+
+    res = Result(name)
+    deadline = time.monotonic() + seconds
+
+    async def writer():
+        while time.monotonic() < deadline:
+            try:
+                async with Session() as db:
+                    await award(db, random.choice(snaps), task, 1, None)
+                res.writes += 1
+            except OperationalError:
+                res.errors += 1
+
+    async def reader():
+        while time.monotonic() < deadline:
+            try:
+                async with Session() as db:
+                    await leaderboard(db, "week", limit=10)
+                res.reads += 1
+            except OperationalError:
+                res.errors += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[writer() for _ in range(writers)], *[reader() for _ in range(readers)])
+    res.seconds = time.monotonic() - start
+    await eng.dispose()
+    return res
+
+async def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="DATABASE_URL пустой базы (по умолчанию — временные SQLite-файлы)")
+    ap.add_argument("--seconds", type=float, default=5)
+    ap.add_argument("--writers", type=int, default=4)
+    ap.add_argument("--readers", type=int, default=8)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--profile", choices=sorted(PROFILES), action="append", help="какие профили гонять (по умолчанию все)")
+    args = ap.parse_args()
+    print(f"{'profile':<10} {'writes/s':>10} {'reads/s':>10} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.profile or sorted(PROFILES):
+            url = args.url or f"sqlite:///{os.path.join(tmp, name + '.sqlite3')}"
+            res = await run(url, name, PROFILES[name], args.seconds, args.writers, args.readers, args.users)
+            print(res.row())
+            if args.url:
+                break  # одна база — один прогон; другой профиль запускайте отдельно с --profile
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,291 @@
+"""Нагрузочный тест пути вебхука целиком: POST /webhook/{secret} -> очередь -> хендлер -> БД -> Bot API.
+
+ASGI-приложение вызывается в процессе, Bot API подменяется локальным фейковым сервером (aiohttp),
+так что исходящие запросы бота — настоящие HTTP-вызовы, но без Telegram.
+
+    python -m bench.webhook --users 500 --submissions 50000 --updates 2000 --concurrency 50
+    python -m bench.webhook --compare bench/results/20260101-120000.json
+
+База по умолчанию — временный SQLite-файл; --url — отдельная пустая база (Postgres и т.п.).
+Результаты сохраняются в bench/results/<время>.json; --compare печатает разницу с прошлым прогоном.
+"""
+from __future__ import annotations
+import argparse, asyncio, json, os, random, sys, tempfile, time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+BOT_TOKEN = "123456:bench"
+SECRET = "bench"
+MANAGER_TG_ID = 1
+PLAYER_BASE = 100_000
+RESULTS_DIR = Path(__file__).parent / "results"
+
+# доли команд в смеси апдейтов
+MIX = {"start": 0.1, "me": 0.3, "top": 0.3, "tasks": 0.1, "log": 0.2}
+
+
+def _configure_env(url: str) -> None:
+    """Настройки приложения читаются при импорте — выставляем до импорта app.*"""
+    os.environ["DATABASE_URL"] = url
+    os.environ["TELEGRAM_TOKEN"] = BOT_TOKEN
+    os.environ["WEBHOOK_SECRET"] = SECRET
+    os.environ["MANAGER_IDS"] = str(MANAGER_TG_ID)
+    os.environ.setdefault("LOG_UPDATE_SAMPLE", "0")
+    # уведомления о уровнях не должны упираться в лимиты Telegram в бенчмарке
+    os.environ.setdefault("OUTBOX_RATE", "100000")
+    os.environ.setdefault("OUTBOX_CHAT_INTERVAL", "0")
+    os.environ.setdefault("OUTBOX_GROUP_INTERVAL", "0")
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    k = min(len(s) - 1, max(0, round(p / 100 * (len(s) - 1))))
+    return s[k]
+
+# --- фейковый Bot API --------------------------------------------------------------
+
+async def start_fake_telegram():
+    """Отвечает на /bot<token>/<method> как Telegram: sendMessage -> Message, остальное -> True."""
+    from aiohttp import web
+    calls = {"count": 0}
+
+    async def handle(request: web.Request):
+        calls["count"] += 1
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        if method == "sendmessage":
+            chat_id = int(data.get("chat_id", 0))
+            result = {"message_id": calls["count"], "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                      "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", calls
+
+# --- ASGI без HTTP-клиента -------------------------------------------------------------
+
+async def asgi_post(app, path: str, body: bytes) -> int:
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0), "server": ("bench", 80),
+    }
+    sent = False
+    status = 0
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+# --- данные ------------------------------------------------------------------------------
+
+async def seed(users: int, submissions: int) -> None:
+    from sqlalchemy import insert, select, func
+    from app.db import AsyncSessionLocal
+    from app.models import User, Submission
+    from app.search import task_index
+    from app.logic import reconcile_xp, rebuild_period_xp
+
+    async with AsyncSessionLocal() as db:
+        if await db.scalar(select(func.count()).select_from(User)):
+            raise SystemExit("users не пуста — запускайте на отдельной пустой базе")
+        rows = [{"tg_id": MANAGER_TG_ID, "username": "manager", "full_name": "Manager", "is_manager": True, "xp_total": 0}]
+        rows += [{"tg_id": PLAYER_BASE + i, "username": f"p{i}", "full_name": f"Player {i}", "is_manager": False, "xp_total": 0}
+                 for i in range(users)]
+        await db.execute(insert(User), rows)
+        await db.commit()
+        ids = list(await db.scalars(select(User.id).where(User.tg_id >= PLAYER_BASE)))
+        tasks = task_index().tasks
+        now = datetime.now(timezone.utc)
+        chunk = 10_000
+        for start in range(0, submissions, chunk):
+            batch = []
+            for _ in range(min(chunk, submissions - start)):
+                t = random.choice(tasks)
+                batch.append({"user_id": random.choice(ids), "task_id": t.id, "manager_id": None, "count": 1,
+                              "xp_awarded": t.xp, "created_at": now - timedelta(seconds=random.randint(0, 90 * 86400))})
+            await db.execute(insert(Submission), batch)
+            await db.commit()
+        await reconcile_xp(db, fix=True)
+        await rebuild_period_xp(db)
+
+
+def make_updates(n: int, users: int) -> list[tuple[str, dict]]:
+    from app.search import task_index
+    codes = [t.code for t in task_index().tasks]
+    kinds, weights = zip(*MIX.items())
+    out = []
+    for i in range(1, n + 1):
+        kind = random.choices(kinds, weights)[0]
+        player = PLAYER_BASE + random.randrange(users)
+        if kind == "log":
+            sender, text = MANAGER_TG_ID, f"/log @p{player - PLAYER_BASE} {random.choice(codes)} {random.randint(1, 3)}"
+        elif kind == "top":
+            sender, text = player, f"/top {random.choice(['week', 'month', 'all'])}"
+        else:
+            sender, text = player, f"/{kind}"
+        cmd_len = len(text.split()[0])
+        out.append((kind, {"update_id": i, "message": {
+            "message_id": i, "date": int(time.time()), "chat": {"id": sender, "type": "private"},
+            "from": {"id": sender, "is_bot": False, "first_name": f"U{sender}", "username": "manager" if sender == MANAGER_TG_ID else f"p{sender - PLAYER_BASE}"},
+            "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": cmd_len}]}}))
+    return out
+
+# --- прогон ------------------------------------------------------------------------------
+
+async def run(args) -> dict:
+    from aiogram.client.telegram import TelegramAPIServer
+    import app.server as srv
+    from app import metrics
+
+    runner, base, calls = await start_fake_telegram()
+    await srv.on_startup()
+    await srv.app.state.warmup
+    if not srv.app.state.ready.is_set():
+        raise SystemExit("startup failed")
+    srv.app.state.bot.session.api = TelegramAPIServer.from_base(base)
+    try:
+        t0 = time.perf_counter()
+        await seed(args.users, args.submissions)
+        seed_s = time.perf_counter() - t0
+        updates = make_updates(args.updates, args.users)
+
+        # сквозная латентность: от POST до конца обработки апдейта воркером
+        started: dict[int, float] = {}
+        kind_of: dict[int, str] = {}
+        latencies: dict[str, list[float]] = {k: [] for k in MIX}
+        queue = srv.app.state.updates
+        dp = queue.dp
+        feed = dp.feed_update
+
+        async def timed_feed(bot, update, **kw):
+            try:
+                return await feed(bot, update, **kw)
+            finally:
+                uid = update.update_id
+                if uid in started:
+                    latencies[kind_of[uid]].append(time.perf_counter() - started.pop(uid))
+
+        dp.feed_update = timed_feed
+        db_before = {k: list(v) for k, v in metrics.update_db_queries.values.items()}
+        sem = asyncio.Semaphore(args.concurrency)
+        statuses: dict[int, int] = {}
+        path = f"/webhook/{SECRET}"
+
+        async def one(kind: str, payload: dict):
+            async with sem:
+                body = json.dumps(payload).encode()
+                started[payload["update_id"]] = time.perf_counter()
+                kind_of[payload["update_id"]] = kind
+                st = await asgi_post(srv.app, path, body)
+                statuses[st] = statuses.get(st, 0) + 1
+                if st != 200:  # отклонён (503) — до воркера не дойдёт
+                    started.pop(payload["update_id"], None)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(k, p) for k, p in updates))
+        await asyncio.gather(*(q.join() for q in queue.queues))
+        wall = time.perf_counter() - t0
+        dp.feed_update = feed
+    finally:
+        await srv.on_shutdown()
+        await runner.cleanup()
+
+    # среднее число запросов к БД на апдейт по хендлерам — из гистограмм metrics (прирост за прогон)
+    db_queries = {}
+    for labels, v in metrics.update_db_queries.values.items():
+        prev = db_before.get(labels, [0] * len(v))
+        cnt, total = v[-1] - prev[-1], v[-2] - prev[-2]
+        if cnt:
+            db_queries[labels[0]] = round(total / cnt, 2)
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": {k: getattr(args, k) for k in ("users", "submissions", "updates", "concurrency")},
+        "db": "sqlite" if not args.url else args.url.split(":", 1)[0],
+        "seed_seconds": round(seed_s, 2),
+        "wall_seconds": round(wall, 3),
+        "throughput_ups": round(len(updates) / wall, 1),
+        "http_statuses": statuses,
+        "bot_api_calls": calls["count"],
+        "latency_ms": {
+            k: {"n": len(v), "p50": round(percentile(v, 50) * 1000, 2), "p95": round(percentile(v, 95) * 1000, 2),
+                "p99": round(percentile(v, 99) * 1000, 2)}
+            for k, v in latencies.items()
+        },
+        "db_queries_per_update": db_queries,
+        "startup": srv.startup_report.as_dict(),
+    }
+
+
+def report(res: dict, prev: dict | None) -> None:
+    def delta(cur: float, old: float | None) -> str:
+        if not old:
+            return ""
+        return f" ({(cur - old) / old * 100:+.0f}%)"
+    p = prev or {}
+    print(f"updates: {res['params']['updates']}, wall {res['wall_seconds']}s, "
+          f"throughput {res['throughput_ups']} upd/s{delta(res['throughput_ups'], p.get('throughput_ups'))}")
+    print(f"http: {res['http_statuses']}, bot api calls: {res['bot_api_calls']}, seed: {res['seed_seconds']}s")
+    print(f"{'command':<8} {'n':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for k, v in res["latency_ms"].items():
+        old = p.get("latency_ms", {}).get(k, {})
+        print(f"{k:<8} {v['n']:>6} {v['p50']:>10}{delta(v['p50'], old.get('p50')):>7} "
+              f"{v['p95']:>10}{delta(v['p95'], old.get('p95')):>7} {v['p99']:>10}{delta(v['p99'], old.get('p99')):>7}")
+    print("db queries per update:", res["db_queries_per_update"])
+    if "startup" in res:
+        marks = res["startup"]["marks"]
+        print("startup, s:", {k: marks[k] for k in ("imported", "serving", "ready", "first_update") if k in marks},
+              "imports:", res["startup"]["imports"])
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="DATABASE_URL пустой базы (по умолчанию — временный SQLite-файл)")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--submissions", type=int, default=20_000)
+    ap.add_argument("--updates", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--seed", type=int, default=42, help="seed генератора случайных данных")
+    ap.add_argument("--compare", type=Path, help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--no-save", action="store_true")
+    args = ap.parse_args()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure_env(args.url or f"sqlite:///{os.path.join(tmp, 'bench.sqlite3')}")
+        os.chdir(tmp)  # импорт Excel ищет data/ относительно cwd — берутся задания по умолчанию
+        res = asyncio.run(run(args))
+    prev = json.loads(args.compare.read_text()) if args.compare else None
+    report(res, prev)
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        out = RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        out.write_text(json.dumps(res, ensure_ascii=False, indent=2))
+        print("saved:", out, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()